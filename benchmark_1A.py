@@ -0,0 +1,195 @@
+import argparse
+import io
+import json
+import math
+import random
+import time
+
+import pymupdf
+
+from main_1A import document_stages, pdf_outline_extractor
+
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud").split()
+
+
+def make_synthetic_pdf(page_count, lines_per_page=45, heading_ratio=0.08, font_sizes=(11, 14, 18),
+                       underline_ratio=0.3, rulings_per_page=0, header_footer=True, image_cover=False,
+                       seed=0):
+    # Builds a deterministic PDF in memory. Body lines use font_sizes[0], the
+    # remaining sizes are used for headings (bold, some underlined), and
+    # rulings_per_page adds table-style horizontal rules that stress the
+    # underline matching. Returns the PDF bytes.
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+
+    if image_cover:
+        from PIL import Image, ImageDraw
+
+        cover = Image.new("RGB", (612, 792), "white")
+        ImageDraw.Draw(cover).text((60, 80), "SYNTHETIC SCANNED COVER", fill="black")
+        cover_png = io.BytesIO()
+        cover.save(cover_png, format="PNG")
+        page = doc.new_page()
+        page.insert_image(page.rect, stream=cover_png.getvalue())
+
+    body_size = font_sizes[0]
+    heading_sizes = font_sizes[1:] or (body_size,)
+    for page_idx in range(page_count):
+        page = doc.new_page()
+        line_height = (page.rect.height - 120) / lines_per_page
+
+        if header_footer:
+            page.insert_text((72, 40), "Synthetic Report Header", fontsize=9)
+            page.insert_text((72, page.rect.height - 30), f"Page {page_idx + 1}", fontsize=9)
+
+        y = 80
+        for _ in range(lines_per_page):
+            if rng.random() < heading_ratio:
+                size = rng.choice(heading_sizes)
+                text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+                page.insert_text((72, y), text, fontsize=size, fontname="hebo")
+                if rng.random() < underline_ratio:
+                    page.draw_line((72, y + 3), (72 + len(text) * size * 0.5, y + 3), width=0.5)
+            else:
+                text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 14)))
+                page.insert_text((72, y), text, fontsize=body_size)
+            y += line_height
+
+        for _ in range(rulings_per_page):
+            rule_y = rng.uniform(80, page.rect.height - 60)
+            page.draw_line((60, rule_y), (page.rect.width - 60, rule_y), width=0.3)
+
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def _timed(timings, stage, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+
+def time_stages(pdf_bytes):
+    # Times each stage of pdf_outline_extractor.extract() and the title path
+    # separately on a freshly opened document. Underline detection runs inside
+    # step_2, so its share is measured by wrapping _get_underline_bboxes.
+    timings = {}
+
+    pdf = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        extractor = pdf_outline_extractor(pdf_doc=pdf)
+        get_underline_bboxes = extractor._get_underline_bboxes
+        extractor._get_underline_bboxes = lambda page: _timed(timings, "underline_bboxes", get_underline_bboxes, page)
+
+        _timed(timings, "step_1", extractor.step_1_extract_features)
+        _timed(timings, "step_2", extractor.step_2_analyze_styles)
+        candidates = _timed(timings, "step_3", extractor.step_3_score_and_classify_headings)
+        if not candidates:
+            candidates = _timed(timings, "step_3", extractor.step_3_score_and_classify_headings, allow_body_size=True)
+        refined = _timed(timings, "step_4", extractor.step_4_refine_with_word_count, candidates)
+        hierarchical = _timed(timings, "step_5", extractor.step_5_enforce_hierarchy, refined)
+        _timed(timings, "step_6", extractor.step_6_merge_consecutive_headings, hierarchical)
+    finally:
+        pdf.close()
+
+    pdf = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        stages = document_stages(pdf)
+        features = _timed(timings, "title_page_0", lambda: stages.page_0_features)
+        if features is not None and features["needs_ocr"]:
+            _timed(timings, "title_ocr", lambda: stages.ocr_title)
+        elif features is not None:
+            _timed(timings, "title_text", lambda: stages.text_title)
+    finally:
+        pdf.close()
+
+    return timings
+
+
+def _scaling_exponent(points):
+    # Least-squares slope of log(time) against log(pages): ~1 means linear,
+    # noticeably above 1 flags a complexity blow-up.
+    points = [(math.log(x), math.log(y)) for x, y in points if x > 0 and y > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def run_benchmark(page_counts, repeat=3, **corpus_options):
+    results = []
+    for page_count in page_counts:
+        pdf_bytes = make_synthetic_pdf(page_count, **corpus_options)
+        best = {}
+        for _ in range(repeat):
+            for stage, seconds in time_stages(pdf_bytes).items():
+                best[stage] = min(best.get(stage, seconds), seconds)
+        results.append({"pages": page_count, "bytes": len(pdf_bytes), "stages": best})
+    return results
+
+
+def print_report(results):
+    stages = sorted({stage for r in results for stage in r["stages"]})
+    print(f"{'stage':<18}" + "".join(f"{r['pages']:>10}p" for r in results) + f"{'exponent':>10}")
+    for stage in stages:
+        row = f"{stage:<18}"
+        for r in results:
+            seconds = r["stages"].get(stage)
+            row += f"{seconds * 1000:>9.1f}ms" if seconds is not None else f"{'-':>11}"
+        exponent = _scaling_exponent([(r["pages"], r["stages"][stage]) for r in results if stage in r["stages"]])
+        row += f"{exponent:>10.2f}" if exponent is not None else f"{'-':>10}"
+        print(row)
+
+    print()
+    for r in results:
+        extract_seconds = sum(v for k, v in r["stages"].items() if k.startswith("step_"))
+        print(f"{r['pages']:>5} pages: {r['pages'] / extract_seconds:8.1f} pages/s through extract()")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each extraction stage on synthetic PDFs")
+    parser.add_argument("--pages", default="1,5,10,25,50",
+                        help="comma separated page counts to generate")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per document; the fastest is reported")
+    parser.add_argument("--lines-per-page", type=int, default=45)
+    parser.add_argument("--heading-ratio", type=float, default=0.08)
+    parser.add_argument("--font-sizes", default="11,14,18",
+                        help="body size first, then heading sizes")
+    parser.add_argument("--underline-ratio", type=float, default=0.3)
+    parser.add_argument("--rulings-per-page", type=int, default=0)
+    parser.add_argument("--no-header-footer", action="store_true")
+    parser.add_argument("--image-cover", action="store_true",
+                        help="prepend an image-only cover page to exercise the OCR title path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="also write the raw timings to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        [int(p) for p in args.pages.split(",")],
+        repeat=args.repeat,
+        lines_per_page=args.lines_per_page,
+        heading_ratio=args.heading_ratio,
+        font_sizes=tuple(int(s) for s in args.font_sizes.split(",")),
+        underline_ratio=args.underline_ratio,
+        rulings_per_page=args.rulings_per_page,
+        header_footer=not args.no_header_footer,
+        image_cover=args.image_cover,
+        seed=args.seed,
+    )
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as json_output:
+            json.dump(results, json_output, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,302 @@
 import pymupdf
+import argparse
+import bisect
+import hashlib
+import heapq
 import json
-import pytesseract
-from PIL import Image
+import math
+import random
 import io
 import os
+import queue
 import re
-from collections import Counter
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from functools import cached_property
+
+
+# Bump whenever a change alters extraction results, so cached results from
+# older versions are no longer reused.
+EXTRACTOR_VERSION = "1.3"
+
+# The OCR and imaging stack is only needed once a page-0 image has to be
+# OCR'd, so it is imported inside that branch. Importing this module for the
+# text-only path must stay within the budget below and must not pull in any
+# of the deferred modules.
+IMPORT_TIME_BUDGET_MS = 350
+DEFERRED_MODULES = ("PIL", "pandas", "tesserocr", "subprocess", "concurrent.futures.process")
+
+# Settings that shape how a single document is extracted. They travel as one
+# dict from the command line to document_stages and are all part of the
+# result-cache fingerprint.
+DEFAULT_SETTINGS = {
+    "max_heading_word_percentage": 0.10,
+    # Documents with at least this many pages use the bounded-memory
+    # extract_streaming(); 0 disables it.
+    "streaming_min_pages": 0,
+    # In streaming mode, estimate the body style and header/footer blacklist
+    # from a stratified sample of this many pages instead of two full
+    # passes; 0 scans every page.
+    "sample_pages": 0,
+    # Scanned-document mode: image-only pages are OCR'd and their lines scored
+    # like text lines. The render resolution is lowered (down to OCR_MIN_DPI)
+    # until all of a document's scanned pages fit in this many megapixels;
+    # 0, the default, leaves image-only pages alone.
+    "ocr_megapixels": 0,
+    "ocr_max_dpi": 300,
+    "ocr_threads": 4,
+    # Per-document time budget in seconds; 0 means no deadline. See
+    # DEGRADATION_STEPS for what is given up as it runs out.
+    "deadline_s": 0,
+}
+
+# Share of the deadline after which each step is skipped for the rest of the
+# document, in the order they are given up: underline detection from vector
+# drawings first, then OCR, and finally no further pages are scanned.
+DEGRADATION_STEPS = {"underlines": 0.5, "ocr": 0.7, "pages": 0.9}
+
+# The watchdog aborts a document that is still running this many times past
+# its deadline, e.g. one looping over thousands of pages or OCR results. It
+# can't interrupt a single long MuPDF call (a render, get_cdrawings() on a
+# page of huge vector drawings); those are stopped only once the call returns.
+WATCHDOG_GRACE = 2.0
+
+# Weights of estimate_cost(), in text pages: a scanned page that has to be
+# rendered and OCR'd, and one megabyte of file (fonts, images, streams).
+OCR_PAGE_COST = 20
+COST_PER_MB = 2
+
+
+class block_store:
+    # Column-oriented storage for the per-line features collected in step 1.
+    # Documents produce tens of thousands of lines, so instead of one dict per
+    # line every feature lives in its own compact array and the text-derived
+    # flags used for scoring are computed once, when the line is added.
+
+    ALIGNMENTS = ("left", "center", "right")
+
+    def __init__(self):
+        self.text = []
+        self.font_name = []
+        self.font_size = array('l')
+        self.color = array('l')
+        self.alignment = array('b')
+        self.page_num = array('l')
+        self.y_coord = array('d')
+        self.x0 = array('d')
+        self.x1 = array('d')
+        self.y1 = array('d')
+        self.length = array('l')
+        self.is_bold = array('b')
+        self.is_underlined = array('b')
+        self.is_upper = array('b')
+        self.has_alpha = array('b')
+
+    def __len__(self):
+        return len(self.text)
+
+    def append(self, block_info):
+        text = block_info["text"]
+        self.text.append(text)
+        self.font_name.append(block_info["font_name"])
+        self.font_size.append(block_info["font_size"])
+        self.color.append(block_info["color"])
+        self.alignment.append(self.ALIGNMENTS.index(block_info["alignment"]))
+        self.page_num.append(block_info["page_num"])
+        self.y_coord.append(block_info["y_coord"])
+        self.x0.append(block_info["bbox"][0])
+        self.x1.append(block_info["bbox"][2])
+        self.y1.append(block_info["bbox"][3])
+        self.length.append(block_info["length"])
+        self.is_bold.append("bold" in block_info["font_name"].lower())
+        self.is_underlined.append(bool(block_info["is_underlined"]))
+        self.is_upper.append(text.isupper() and len(text.split()) > 1)
+        self.has_alpha.append(any(c.isalpha() for c in text))
+
+    def extend(self, other):
+        for name, column in vars(self).items():
+            column.extend(getattr(other, name))
+
+    def filter(self, keep):
+        # Returns a new store holding only the rows whose flag in `keep` is true.
+        kept = block_store()
+        for name, column in vars(self).items():
+            values = [v for v, k in zip(column, keep) if k]
+            setattr(kept, name, array(column.typecode, values) if isinstance(column, array) else values)
+        return kept
+
+    def row(self, i):
+        return {
+            "text": self.text[i],
+            "font_size": self.font_size[i],
+            "font_name": self.font_name[i],
+            "color": self.color[i],
+            "alignment": self.ALIGNMENTS[self.alignment[i]],
+            "page_num": self.page_num[i],
+            "y_coord": self.y_coord[i],
+            "length": self.length[i],
+            "is_underlined": bool(self.is_underlined[i]),
+        }
+
+
+class document_metrics:
+    # Per-document instrumentation: wall and CPU time per named stage plus
+    # simple counters. Recording is cheap enough to be always on; the numbers
+    # only leave the process when a metrics output is requested.
+
+    def __init__(self, source=None):
+        self.source = source
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            timing = self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0})
+            timing["wall_s"] += time.perf_counter() - wall_start
+            timing["cpu_s"] += time.process_time() - cpu_start
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def to_dict(self):
+        try:
+            import resource
+            # ru_maxrss is the peak RSS of this (worker) process so far, in KiB on Linux.
+            peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            peak_rss_kb = None
+
+        return {
+            "source": self.source,
+            "stages": {
+                name: {"wall_s": round(t["wall_s"], 6), "cpu_s": round(t["cpu_s"], 6)}
+                for name, t in self.stages.items()
+            },
+            "counters": self.counters,
+            "peak_rss_kb": peak_rss_kb,
+        }
+
+
+class document_deadline:
+    # Time budget of one document, started when it is created. Stages call
+    # allows(step) between pages and stages; once the share of the budget
+    # given in DEGRADATION_STEPS is used up, the step is refused from then on
+    # and recorded in `degraded`, in the order it happened.
+
+    def __init__(self, seconds=0):
+        self.seconds = seconds
+        self.start = time.monotonic()
+        self.degraded = []
+
+    def allows(self, step):
+        if not self.seconds:
+            return True
+        if step in self.degraded:
+            return False
+        if time.monotonic() - self.start < self.seconds * DEGRADATION_STEPS[step]:
+            return True
+        print(f"Deadline of {self.seconds:g}s running out, skipping {step}")
+        self.degraded.append(step)
+        return False
+
+
+class watchdog_expired(BaseException):
+    # Raised by document_watchdog's signal handler. Deriving from
+    # BaseException keeps the `except Exception` and `except OSError`
+    # handlers inside the pipeline (OCR, caches) from swallowing it.
+    pass
+
+
+@contextmanager
+def document_watchdog(seconds):
+    # Hard stop for a runaway document: SIGALRM interrupts it after `seconds`
+    # and the block is left with a TimeoutError, so the worker reports it as
+    # failed and moves on. The Python handler only runs between bytecodes, so
+    # a document stuck inside one MuPDF call is stopped when that call
+    # returns, not before. Signals are only delivered to the main thread of a
+    # POSIX process; anywhere else this does nothing and only the soft
+    # deadline applies.
+    import signal
+
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise watchdog_expired(f"still running after {seconds:g}s, stopped by the watchdog")
+
+    previous_handler = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    except watchdog_expired as e:
+        raise TimeoutError(str(e)) from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+class page_layout:
+    # The text dict and image geometry of one page, each extracted at most
+    # once. document_stages builds one for page 0 and hands it to the outline
+    # extractor, so title detection and step_1 share a single parse.
+
+    def __init__(self, page):
+        self.page = page
+
+    @cached_property
+    def blocks(self):
+        return self.page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
+
+    @cached_property
+    def is_empty(self):
+        return not any(
+            span["text"].strip()
+            for block in self.blocks for line in block.get("lines", []) for span in line["spans"]
+        )
+
+    @cached_property
+    def image_rects(self):
+        return [pymupdf.Rect(img['bbox']) for img in self.page.get_image_info()]
 
 
 class pdf_outline_extractor:
 
-    def __init__(self, pdf_doc, max_heading_word_percentage=0.10): # Corrected __init__
+    def __init__(self, pdf_doc, max_heading_word_percentage=0.10, metrics=None, ocr_megapixels=0,
+                 ocr_max_dpi=300, ocr_threads=1, ocr_cache=None, deadline=None,
+                 page_cache=None, layouts=None): # Corrected __init__
 
         self.doc = pdf_doc
+        self.metrics = metrics if metrics is not None else document_metrics()
         self.max_heading_word_percent = max_heading_word_percentage
+        self.ocr_megapixels = ocr_megapixels
+        self.ocr_max_dpi = ocr_max_dpi
+        self.ocr_threads = ocr_threads
+        self.ocr_cache = ocr_cache
+        self.deadline = deadline if deadline is not None else document_deadline()
+        self.page_cache = page_cache
+        self.page_fingerprints = {}
+        self.object_digests = {}
+        self.page_cache_pending = {}
+        self.page_cache_hits = 0
+        # page index -> page_layout already built elsewhere (e.g. page 0 for the title)
+        self.layouts = layouts or {}
         self.total_words_in_doc = 0
-        self.all_blocks_data = []
+        self.all_blocks_data = block_store()
         self.body_style = {}
         self.heading_font_sizes = []
+        self.scored_candidates = None
+        self.underline_bboxes = {}
+        self.underline_y0s = {}
 
     def get_text_alignment(self, line_bbox, page_width):
         x0, y0, x1, y1 = line_bbox
@@ -33,97 +312,367 @@ class pdf_outline_extractor:
             return "right"
         return "left"
 
-    def _get_underline_bboxes(self):
-        self.underline_bboxes = {}
-        for page_idx in range(self.doc.page_count): # Renamed loop variable to avoid conflict
-            self.underline_bboxes[page_idx + 1] = []
-            drawings = self.doc[page_idx].get_drawings()
-            for path in drawings:
-
-                if path['rect'].height < 2 and path['rect'].width > 5:
-                    self.underline_bboxes[page_idx + 1].append(path['rect'])
-
-    def step_1_extract_features(self):
-        header_footer_candidates = Counter()
-        page_count = self.doc.page_count
-        for page_idx in range(page_count): # Renamed loop variable
-            page = self.doc[page_idx] # Changed page_num to page for clarity as it's a PyMuPDF page object
-            self.total_words_in_doc += len(page.get_text("words"))
-            page_height = page.rect.height
-            page_width = page.rect.width
-            header_zone = page_height * 0.12
-            footer_zone = page_height * 0.88
-
+    def _get_underline_bboxes(self, page):
+        # get_cdrawings() is get_drawings() without the conversion of every
+        # path item to Python objects; only the path rects are needed here.
+        underline_bboxes = []
+        for path in page.get_cdrawings():
+            x0, y0, x1, y1 = path['rect']
+            if y1 - y0 < 2 and x1 - x0 > 5:
+                underline_bboxes.append(pymupdf.Rect(path['rect']))
+
+        # Kept sorted by top edge so _is_underlined can bisect to the rules
+        # near a baseline instead of scanning every ruling line on the page.
+        underline_bboxes.sort(key=lambda r: r.y0)
+        return underline_bboxes
+
+    def _is_underlined(self, line_bbox, page_num):
+        x0, _, x1, y1 = line_bbox
+        u_bboxes = self.underline_bboxes.get(page_num, [])
+        u_y0s = self.underline_y0s.get(page_num, [])
+
+        lo = bisect.bisect_left(u_y0s, y1 - 2)
+        hi = bisect.bisect_right(u_y0s, y1 + 2)
+        for u_bbox in u_bboxes[lo:hi]:
+
+            if abs(u_bbox.y0 - y1) < 2 and max(x0, u_bbox.x0) < min(x1, u_bbox.x1):
+                return True
+        return False
+
+    def _page_lines(self, page, count_words=True):
+        # Yields (line, line_text, main_span) for every text line of the page
+        # that has a usable span; main_span is the largest span with more than
+        # three characters. Adds the page's words to the document total.
+        layout = self.layouts.get(page.number)
+        if layout is not None:
+            blocks = layout.blocks
+        else:
             blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
-            for block in blocks:
-                for line_step1 in block.get("lines", []):
-                    spans = line_step1.get("spans")
-                    if not spans:
-                        continue
-
-                    line_text = None
-                    main_span = None
-
-                    sorted_spans = sorted(spans, key=lambda s: s['size'], reverse=True)
-
-                    for span in sorted_spans:
-
-                        if len(span['text'].strip()) > 3:
-                            main_span = span
+        for block in blocks:
+            for line in block.get("lines", []):
+                spans = line.get("spans")
+                if not spans:
+                    continue
+
+                if count_words:
+                    # Same count get_text("words") gives: words never span lines,
+                    # but may run across spans within a line.
+                    self.total_words_in_doc += len("".join(span['text'] for span in spans).split())
+
+                line_text = None
+                main_span = None
+
+                sorted_spans = sorted(spans, key=lambda s: s['size'], reverse=True)
+
+                for span in sorted_spans:
+
+                    if len(span['text'].strip()) > 3:
+                        main_span = span
+
+                        line_text = span['text'].strip()
+                        break
+
+                if not main_span:
+                    continue
+
+                yield line, line_text, main_span
+
+    def _block_info(self, line, line_text, main_span, page_num, page_width):
+        return {
+            "text": line_text,
+            "font_size": round(main_span["size"]),
+            "font_name": main_span["font"],
+            "color": main_span["color"],
+            "alignment": self.get_text_alignment(line["bbox"], page_width),
+            "page_num": page_num,
+            "y_coord": line["bbox"][1],
+            "bbox": line["bbox"],
+            "length": len(line_text),
+            # Filled in later by _mark_underlines, once the body style is known.
+            "is_underlined": False
+        }
 
-                            line_text = span['text'].strip()
-                            break
+    def _header_footer_text(self, line, line_text, page_height):
+        # Normalised text of a line sitting in the header or footer zone, or
+        # None for lines elsewhere on the page.
+        is_header = line["bbox"][1] < page_height * 0.12
+        is_footer = line["bbox"][3] > page_height * 0.88
+        if is_header or is_footer:
+            normalized_text = re.sub(r'\d+', '', line_text).strip().lower()
+            if len(normalized_text) > 4:
+                return normalized_text
+        return None
+
+    def _mark_underlines(self, blocks):
+        # Underlines are worth one point of heading score, so they only matter
+        # for lines within a point of the heading threshold without them (see
+        # _base_scores). Only pages with such lines have their drawings read,
+        # and only the rules just under those lines are matched, so pages of
+        # plain body text or pure graphics never pay for drawing extraction.
+        lines_by_page = {}
+        for i, _, score, has_alpha in self._base_scores(blocks):
+            if score >= 1 and has_alpha:
+                lines_by_page.setdefault(blocks.page_num[i], []).append(i)
 
-                    if not main_span:
-                        continue
+        self.underline_bboxes = {}
+        self.underline_y0s = {}
+        for page_num, lines in lines_by_page.items():
+            self._set_page_underlines(self.doc[page_num - 1], page_num)
+            for i in lines:
+                line_bbox = (blocks.x0[i], blocks.y_coord[i], blocks.x1[i], blocks.y1[i])
+                blocks.is_underlined[i] = self._is_underlined(line_bbox, page_num)
+
+    def _set_page_underlines(self, page, page_num):
+        if self.deadline.allows("underlines"):
+            self.underline_bboxes[page_num] = self._cached_underline_bboxes(page, page_num)
+        else:
+            self.underline_bboxes[page_num] = []
+        self.underline_y0s[page_num] = [r.y0 for r in self.underline_bboxes[page_num]]
+
+    def _cached_underline_bboxes(self, page, page_num):
+        fingerprint = self.page_fingerprints.get(page_num)
+        if fingerprint is None:
+            return self._get_underline_bboxes(page)
+
+        key = self.page_cache.make_key(fingerprint, "underlines")
+        rects = self.page_cache.get(key)
+        if rects is None:
+            rects = [tuple(r) for r in self._get_underline_bboxes(page)]
+            self.page_cache_pending[key] = rects
+        return [pymupdf.Rect(r) for r in rects]
+
+    def _page_fingerprint(self, page):
+        # SHA-256 over everything the page's features depend on: its content
+        # stream, its geometry and every object reachable from the fonts,
+        # images and form XObjects it uses. Objects are hashed by content
+        # rather than by xref number, so an incremental save that edits or
+        # appends other pages leaves this page's fingerprint unchanged.
+        digest = hashlib.sha256(page.read_contents())
+        digest.update(repr((tuple(page.rect), page.rotation)).encode())
+        xrefs = ({font[0] for font in page.get_fonts()} | {image[0] for image in page.get_images()}
+                 | {xobject[0] for xobject in page.get_xobjects()})
+        for object_digest in sorted(self._object_digest(xref, set()) for xref in xrefs if xref > 0):
+            digest.update(object_digest)
+        return digest.hexdigest()
+
+    def _object_digest(self, xref, visiting):
+        # Memoised per document: fonts and images shared by many pages are
+        # hashed once. A reference cycle contributes its xref number instead.
+        if xref in self.object_digests:
+            return self.object_digests[xref]
+        if xref in visiting:
+            return str(xref).encode()
+        visiting.add(xref)
+
+        source = self.doc.xref_object(xref, compressed=True)
+        digest = hashlib.sha256(re.sub(r'\d+ \d+ R', 'R', source).encode())
+        for ref in re.findall(r'(\d+) \d+ R', source):
+            digest.update(self._object_digest(int(ref), visiting))
+        if self.doc.xref_is_stream(xref):
+            digest.update(self.doc.xref_stream_raw(xref) or b"")
+
+        visiting.discard(xref)
+        self.object_digests[xref] = digest.digest()
+        return self.object_digests[xref]
+
+    def _page_features(self, page, page_num):
+        # Everything step_1 takes from one page: its line records, word count,
+        # header/footer texts and whether it is image-only. With a page cache
+        # the features of a page seen before (in any document) are loaded
+        # instead of parsed.
+        key = None
+        if self.page_cache is not None:
+            fingerprint = self.page_fingerprints[page_num] = self._page_fingerprint(page)
+            key = self.page_cache.make_key(fingerprint, "features")
+            features = self.page_cache.get(key)
+            if features is not None:
+                self.page_cache_hits += 1
+                return features
+
+        # _page_lines adds to the document's word total; step_1 adds each
+        # page's count itself so that cached and parsed pages count alike.
+        words_before = self.total_words_in_doc
+        lines = []
+        header_footer = []
+        for line, line_text, main_span in self._page_lines(page):
+            lines.append(self._block_info(line, line_text, main_span, page_num, page.rect.width))
+
+            normalized_text = self._header_footer_text(line, line_text, page.rect.height)
+            if normalized_text:
+                header_footer.append(normalized_text)
+        words = self.total_words_in_doc - words_before
+        self.total_words_in_doc = words_before
+
+        features = {
+            "lines": lines,
+            "words": words,
+            "header_footer": header_footer,
+            "image_only": not lines and bool(page.get_images()),
+        }
+        if key is not None:
+            self.page_cache_pending[key] = features
+        return features
 
-                    is_underlined = False
-                    line_bbox = pymupdf.Rect(line_step1["bbox"])
-                    for u_bbox in self.underline_bboxes.get(page_idx + 1, []): # Use page_idx
-
-                        if abs(u_bbox.y0 - line_bbox.y1) < 2 and \
-                                max(line_bbox.x0, u_bbox.x0) < min(line_bbox.x1, u_bbox.x1):
-                            is_underlined = True
-                            break
-
-                    block_info = {
-                        "text": line_text,
-                        "font_size": round(main_span["size"]),
-                        "font_name": main_span["font"],
-                        "color": main_span["color"],
-                        "alignment": self.get_text_alignment(line_step1["bbox"], page_width),
-                        "page_num": page_idx + 1, # Changed to page_num
-                        "y_coord": line_step1["bbox"][1],
-                        "length": len(line_text),
-                        "is_underlined": is_underlined
-                    }
-                    self.all_blocks_data.append(block_info)
-
-                    is_header = line_step1["bbox"][1] < header_zone
-                    is_footer = line_step1["bbox"][3] > footer_zone
-                    if is_header or is_footer:
-                        normalized_text = re.sub(r'\d+', '', line_text).strip().lower()
-                        if len(normalized_text) > 4:
-                            header_footer_candidates[normalized_text] += 1
+    def _flush_page_cache(self):
+        if self.page_cache_pending:
+            self.page_cache.put_many(self.page_cache_pending)
+            self.page_cache_pending = {}
 
+    def _make_blacklist(self, header_footer_candidates):
+        page_count = self.doc.page_count
         self.header_footer_blacklist = {
             text for text, count in header_footer_candidates.items()
             if count > page_count / 2 and page_count > 1
         }
 
+    def step_1_extract_features(self, page_features=None):
+        # Single pass over the document: every page is loaded once and its
+        # text dict and word count both come from that one visit. Drawings are
+        # only read later, for the few pages where underlines can matter.
+        #
+        # page_features are collect_page_features() results for consecutive
+        # page ranges, computed by page-range subtasks (see run_batch); they
+        # are merged here instead of parsing the pages again. Scanned pages are
+        # OCR'd here, once for the whole document, so they are rendered at the
+        # same resolution however the document was split.
+        if page_features is None:
+            page_features = [self.collect_page_features()]
+        else:
+            self.all_blocks_data = block_store()
+            self.total_words_in_doc = 0
+            for part in page_features:
+                self.all_blocks_data.extend(part["blocks"])
+                self.total_words_in_doc += part["words"]
+                for step in part["degraded"]:
+                    if step not in self.deadline.degraded:
+                        self.deadline.degraded.append(step)
+
+        header_footer_candidates = Counter()
+        scanned_pages = []
+        for part in page_features:
+            header_footer_candidates.update(part["header_footer"])
+            scanned_pages.extend(part["scanned_pages"])
+
+        if scanned_pages:
+            with self.metrics.stage("ocr_pages"):
+                self._add_scanned_pages(scanned_pages, header_footer_candidates)
+
+        self._make_blacklist(header_footer_candidates)
+
+    def collect_page_features(self, start=0, stop=None):
+        # The per-page half of step_1 for pages [start, stop): text line
+        # records, word count, header/footer counts and the image-only pages
+        # left for OCR. Everything that needs the whole document happens in
+        # step_1 after the ranges are merged.
+        stop = self.doc.page_count if stop is None else stop
+        header_footer_candidates = Counter()
+        scanned_pages = []
+        for page_idx in range(start, stop):
+            if not self.deadline.allows("pages"):
+                break
+            page = self.doc[page_idx] # Changed page_num to page for clarity as it's a PyMuPDF page object
+
+            features = self._page_features(page, page_idx + 1)
+            self.total_words_in_doc += features["words"]
+            for block_info in features["lines"]:
+                # A cached page may have sat at another position when it was stored.
+                block_info["page_num"] = page_idx + 1
+                self.all_blocks_data.append(block_info)
+            header_footer_candidates.update(features["header_footer"])
+
+            if features["image_only"] and self.ocr_megapixels:
+                scanned_pages.append(page_idx + 1)
+
+        if self.page_cache is not None:
+            self.metrics.count("page_cache_hits", self.page_cache_hits)
+            self._flush_page_cache()
+
+        return {
+            "blocks": self.all_blocks_data,
+            "words": self.total_words_in_doc,
+            "header_footer": header_footer_candidates,
+            "scanned_pages": scanned_pages,
+            "degraded": list(self.deadline.degraded),
+        }
+
+    def _add_scanned_pages(self, page_nums, header_footer_candidates):
+        # OCRs image-only pages on a thread pool and adds their lines as if
+        # they were text lines: the OCR line box stands in for the line bbox
+        # (and so for alignment) and the snapped word height for the font size.
+        # Pages are rendered on this thread, since a pymupdf document must not
+        # be used from several threads, and at most two pages per OCR thread
+        # are rendered ahead.
+        from concurrent.futures import ThreadPoolExecutor
+
+        pages = [self.doc[page_num - 1] for page_num in page_nums]
+        dpi = ocr_render_dpi([page.rect for page in pages], self.ocr_megapixels, self.ocr_max_dpi)
+        self.metrics.count("ocr_pages", len(pages))
+        self.metrics.count("ocr_dpi", dpi)
+
+        def render(page):
+            return page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY).tobytes("png")
+
+        def recognise(png_bytes):
+            return ocr_image_words(png_bytes, "png", cache=self.ocr_cache)
+
+        page_words = {}
+        errors = []
+
+        def collect(page_num, future):
+            try:
+                page_words[page_num] = future.result()
+            except Exception as e:
+                errors.append(e)
+                page_words[page_num] = []
+
+        threads = max(1, self.ocr_threads)
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            in_flight = {}
+            for page_num, page in zip(page_nums, pages):
+                if not self.deadline.allows("ocr"):
+                    break
+                if len(in_flight) >= 2 * threads:
+                    oldest = next(iter(in_flight))
+                    collect(oldest, in_flight.pop(oldest))
+                in_flight[page_num] = pool.submit(recognise, render(page))
+            for page_num, future in in_flight.items():
+                collect(page_num, future)
+
+        if errors:
+            print(f"OCR failed on {len(errors)} of {len(page_nums)} scanned pages: {errors[0]}")
+
+        for page_num, page in zip(page_nums, pages):
+            for line_text, bbox, size, word_count in ocr_lines(page_words.get(page_num, []), 72 / dpi):
+                self.total_words_in_doc += word_count
+                if len(line_text) <= 3:
+                    continue
+
+                line = {"bbox": bbox}
+                main_span = {"size": size, "font": "OCR", "color": 0}
+                self.all_blocks_data.append(
+                    self._block_info(line, line_text, main_span, page_num, page.rect.width))
+
+                normalized_text = self._header_footer_text(line, line_text, page.rect.height)
+                if normalized_text:
+                    header_footer_candidates[normalized_text] += 1
+
     def step_2_analyze_styles(self):
-        filtered_blocks = [
-            b for b in self.all_blocks_data
-            if re.sub(r'\d+', '', b["text"]).strip().lower() not in self.header_footer_blacklist
-        ]
-        self.all_blocks_data = filtered_blocks
+        if self.header_footer_blacklist:
+            keep = [
+                re.sub(r'\d+', '', text).strip().lower() not in self.header_footer_blacklist
+                for text in self.all_blocks_data.text
+            ]
+            self.all_blocks_data = self.all_blocks_data.filter(keep)
 
         if not self.all_blocks_data:
             return
 
-        font_sizes = Counter(b["font_size"] for b in self.all_blocks_data)
-        font_colors = Counter(b["color"] for b in self.all_blocks_data)
+        self._set_body_style(Counter(self.all_blocks_data.font_size), Counter(self.all_blocks_data.color))
+        self._mark_underlines(self.all_blocks_data)
+        if self.page_cache is not None:
+            self._flush_page_cache()
 
+    def _set_body_style(self, font_sizes, font_colors):
         body_font_size = font_sizes.most_common(1)[0][0]
         body_font_color = font_colors.most_common(1)[0][0]
         self.body_style = {"size": body_font_size, "color": body_font_color}
@@ -131,51 +680,73 @@ class pdf_outline_extractor:
         unique_sizes = sorted([s for s in font_sizes if s > body_font_size], reverse=True)
         self.heading_font_sizes = unique_sizes
 
-    def step_3_score_and_classify_headings(self, allow_body_size=False):
-
-        candidate_headings = []
-        if not self.body_style:
-            return []
-
-        for block in self.all_blocks_data:
-            score = 0
-
-            is_heading_sized = block["font_size"] > self.body_style.get("size", 0)
-            is_body_sized_candidate = allow_body_size and block["font_size"] == self.body_style.get("size", 0)
-
-            if not (is_heading_sized or is_body_sized_candidate):
+    def _score_blocks(self):
+        self.scored_candidates = self._score_store(self.all_blocks_data)
+
+    def _base_scores(self, blocks):
+        # Yields (i, size, score, has_alpha) for every line at least as large
+        # as the body text, with the heading score of everything but the
+        # underline point.
+        body_size = self.body_style.get("size", 0)
+        body_color = self.body_style.get("color")
+        center = block_store.ALIGNMENTS.index("center")
+
+        rows = zip(blocks.font_size, blocks.is_bold, blocks.alignment, blocks.color,
+                   blocks.is_upper, blocks.length, blocks.has_alpha)
+        for i, (size, bold, alignment, color, upper, length, has_alpha) in enumerate(rows):
+            if size > body_size:
+                score = 2
+            elif size == body_size:
+                score = 0
+            else:
                 continue
 
-            if is_heading_sized:
-                score += 2
-            if "bold" in block["font_name"].lower():
-                score += 2
-            if block["alignment"] == "center":
-                score += 1
-            if block["color"] != self.body_style.get("color"):
-                score += 1
-            if block.get("is_underlined"):
-                score += 1
-            if block["text"].isupper() and len(block["text"].split()) > 1:
-                score += 1
+            score += (2 * bold + (alignment == center) + (color != body_color) + upper
+                      - 3 * (length < 3) - (length > 100))
+            yield i, size, score, has_alpha
+
+    def _score_store(self, blocks):
+        # One pass over the columns scores every line that could be a heading
+        # and sorts it into the strict (larger than body) set or the body-sized
+        # fallback set, so step 3 never has to rescan the document.
+        body_size = self.body_style.get("size", 0)
+        level_of_size = {size: f"H{i + 1}" for i, size in enumerate(self.heading_font_sizes)}
+        body_level = f"H{len(self.heading_font_sizes) + 1}"
+
+        heading_sized = []
+        body_sized = []
+        underlined = blocks.is_underlined
+        for i, size, score, has_alpha in self._base_scores(blocks):
+            score += underlined[i]
+
+            if score >= 2 and has_alpha:
+                if size > body_size:
+                    heading_sized.append((i, level_of_size.get(size), score))
+                else:
+                    body_sized.append((i, body_level, score))
+
+        return heading_sized, body_sized
 
-            if block["length"] < 3:
-                score -= 3
-            if block["length"] > 100:
-                score -= 1
+    def step_3_score_and_classify_headings(self, allow_body_size=False):
 
-            if score >= 2 and any(c.isalpha() for c in block["text"]):
+        if not self.body_style:
+            return []
 
-                if is_heading_sized:
-                    level_index = self.heading_font_sizes.index(block["font_size"])
-                    block["level"] = f"H{level_index + 1}"
+        if self.scored_candidates is None:
+            self._score_blocks()
+        heading_sized, body_sized = self.scored_candidates
 
-                elif is_body_sized_candidate:
+        selected = heapq.merge(heading_sized, body_sized) if allow_body_size else heading_sized
 
-                    block["level"] = f"H{len(self.heading_font_sizes) + 1}"
+        return self._candidate_rows(self.all_blocks_data, selected)
 
-                block["score"] = score
-                candidate_headings.append(block)
+    def _candidate_rows(self, blocks, selected):
+        candidate_headings = []
+        for i, level, score in selected:
+            block = blocks.row(i)
+            block["level"] = level
+            block["score"] = score
+            candidate_headings.append(block)
 
         return candidate_headings
 
@@ -184,48 +755,31 @@ class pdf_outline_extractor:
         if not candidates or self.total_words_in_doc == 0:
             return []
 
-        final_headings = list(candidates)
-
-        def get_heading_stats(headings):
-            word_count = sum(len(h["text"].split()) for h in headings)
-            percent = (word_count / self.total_words_in_doc) if self.total_words_in_doc > 0 else 0
-            return word_count, percent
-
-        heading_word_count, heading_percent = get_heading_stats(final_headings)
-
-        while heading_percent > self.max_heading_word_percent and final_headings:
-
-            present_levels = sorted(
-                list(set(h['level'] for h in final_headings)),
-                key=lambda level: int(level[1:]),
-                reverse=True
-            )
-
-            if not present_levels:
-                break
-
-            lowest_level_str = present_levels[0]
-
-            headings_at_lowest_level = [
-                h for h in final_headings if h['level'] == lowest_level_str
-            ]
-
-            if not headings_at_lowest_level:
-                break
-
-            min_score_at_level = min(h['score'] for h in headings_at_lowest_level)
-
-            batch_to_remove = [
-                h for h in headings_at_lowest_level if h['score'] == min_score_at_level
-            ]
-
-            if not batch_to_remove:
-                break
-
-            ids_to_remove = {id(h) for h in batch_to_remove}
-            final_headings = [h for h in final_headings if id(h) not in ids_to_remove]
-
-            heading_word_count, heading_percent = get_heading_stats(final_headings)
+        # Headings are dropped in batches: all headings of the lowest level that
+        # share the lowest score at that level go together. Grouping by
+        # (level, score) up front turns that into popping groups off a heap
+        # while keeping a running word total, instead of rescanning and
+        # re-splitting every remaining heading after each batch.
+        groups = [(int(h["level"][1:]), h["score"]) for h in candidates]
+        group_word_counts = Counter()
+        for group, h in zip(groups, candidates):
+            group_word_counts[group] += len(h["text"].split())
+
+        removal_order = [(-level_num, score) for level_num, score in group_word_counts]
+        heapq.heapify(removal_order)
+
+        heading_word_count = sum(group_word_counts.values())
+        removed_groups = set()
+
+        while heading_word_count / self.total_words_in_doc > self.max_heading_word_percent and removal_order:
+            neg_level_num, score = heapq.heappop(removal_order)
+            group = (-neg_level_num, score)
+            removed_groups.add(group)
+            heading_word_count -= group_word_counts[group]
+
+        final_headings = [
+            h for group, h in zip(groups, candidates) if group not in removed_groups
+        ]
 
         final_headings.sort(key=lambda x: (x["page_num"], x["y_coord"])) # Changed to page_num
         return final_headings
@@ -279,21 +833,38 @@ class pdf_outline_extractor:
 
         return merged_headings
 
-    def extract(self):
+    def extract(self, page_features=None):
 
-        self._get_underline_bboxes()
-        self.step_1_extract_features()
-        self.step_2_analyze_styles()
+        with self.metrics.stage("step_1"):
+            self.step_1_extract_features(page_features)
+        self.metrics.count("pages", self.doc.page_count)
+        self.metrics.count("lines", len(self.all_blocks_data))
 
-        candidates = self.step_3_score_and_classify_headings(allow_body_size=False)
+        with self.metrics.stage("step_2"):
+            self.step_2_analyze_styles()
+        self.metrics.count("underline_pages", len(self.underline_bboxes))
+        self.metrics.count("underline_rects", sum(len(r) for r in self.underline_bboxes.values()))
 
-        if not candidates:
-            print("No headings found. Retrying with body-sized text as potential headings...")
-            candidates = self.step_3_score_and_classify_headings(allow_body_size=True)
+        with self.metrics.stage("step_3"):
+            candidates = self.step_3_score_and_classify_headings(allow_body_size=False)
+
+            if not candidates:
+                print("No headings found. Retrying with body-sized text as potential headings...")
+                candidates = self.step_3_score_and_classify_headings(allow_body_size=True)
+
+        return self._refine_candidates(candidates)
 
-        refined_headings = self.step_4_refine_with_word_count(candidates)
-        hierarchical_headings = self.step_5_enforce_hierarchy(refined_headings)
-        final_headings = self.step_6_merge_consecutive_headings(hierarchical_headings)
+    def _refine_candidates(self, candidates):
+        self.metrics.count("candidates_before_step_4", len(candidates))
+
+        with self.metrics.stage("step_4"):
+            refined_headings = self.step_4_refine_with_word_count(candidates)
+        self.metrics.count("candidates_after_step_4", len(refined_headings))
+
+        with self.metrics.stage("step_5"):
+            hierarchical_headings = self.step_5_enforce_hierarchy(refined_headings)
+        with self.metrics.stage("step_6"):
+            final_headings = self.step_6_merge_consecutive_headings(hierarchical_headings)
 
         outline = [
             {"level": h["level"], "text": h["text"], "page_num": h["page_num"]} # Changed to page_num
@@ -301,364 +872,1898 @@ class pdf_outline_extractor:
         ]
         return outline
 
+    def _sample_statistics(self, sample_pages, z=3.0):
+        # Estimates the header/footer blacklist and the body font size and
+        # colour from one randomly chosen page in each of `sample_pages` equal
+        # strata of the document. Returns (blacklist, body_size, body_color),
+        # or None when the sample can't tell the answer apart from the
+        # alternatives with z standard errors to spare.
+        page_count = self.doc.page_count
+        rng = random.Random(page_count)
+        sampled_pages = [
+            rng.randrange(k * page_count // sample_pages, (k + 1) * page_count // sample_pages)
+            for k in range(sample_pages)
+        ]
 
-input_dir = 'input'
-output_dir = 'output'
-
-for pdf_name in os.listdir(input_dir):
-    if pdf_name.lower().endswith(".pdf"):
-        print(f"Processing {pdf_name}...")
-
-        pdf_path = os.path.join(input_dir, pdf_name)
-        pdf = pymupdf.open(pdf_path)
+        header_footer_candidates = Counter()
+        sampled_lines = []
+        for page_idx in sampled_pages:
+            page = self.doc[page_idx]
+            for line, line_text, main_span in self._page_lines(page, count_words=False):
+                normalized_text = self._header_footer_text(line, line_text, page.rect.height)
+                if normalized_text:
+                    header_footer_candidates[normalized_text] += 1
+                sampled_lines.append((re.sub(r'\d+', '', line_text).strip().lower(),
+                                      round(main_span["size"]), main_span["color"]))
+
+        # A text is blacklisted when it repeats on more than half the pages;
+        # estimate that rate per sampled page and give up if it's too close.
+        margin = z * math.sqrt(0.25 / len(sampled_pages))
+        blacklist = set()
+        for text, count in header_footer_candidates.items():
+            rate = count / len(sampled_pages)
+            if abs(rate - 0.5) <= margin:
+                return None
+            if rate > 0.5:
+                blacklist.add(text)
+
+        font_sizes = Counter(size for text, size, _ in sampled_lines if text not in blacklist)
+        font_colors = Counter(color for text, _, color in sampled_lines if text not in blacklist)
+        if not font_sizes:
+            return None
+
+        def mode_is_clear(histogram):
+            top = histogram.most_common(2)
+            if len(top) < 2:
+                return True
+            n = sum(histogram.values())
+            p1, p2 = top[0][1] / n, top[1][1] / n
+            return p1 - p2 > z * math.sqrt((p1 + p2 - (p1 - p2) ** 2) / n)
+
+        if not (mode_is_clear(font_sizes) and mode_is_clear(font_colors)):
+            return None
+        return blacklist, font_sizes.most_common(1)[0][0], font_colors.most_common(1)[0][0]
+
+    def extract_streaming(self, sample_pages=0):
+        # Bounded-memory variant of extract() for very long documents. Nothing
+        # is kept per line or per page across the document. The statistics
+        # come first: pass 1 collects the header/footer counts and pass 2 the
+        # font-size and colour histograms of the lines that survive the
+        # header/footer filter (it needs the final blacklist, hence two
+        # passes). Pass 3 then counts words and scores each page's lines, with
+        # only that page's underline rects in memory, keeping just the heading
+        # candidates. Levels are assigned once pass 3 has seen every heading
+        # size. The result is identical to extract().
+        #
+        # With sample_pages, passes 1 and 2 are replaced by a stratified sample
+        # of that many pages, so the statistics cost no longer grows with the
+        # page count. An inconclusive sample falls back to passes 1 and 2, so
+        # memory stays bounded either way.
+        page_count = self.doc.page_count
+        self.metrics.count("pages", page_count)
+
+        statistics = None
+        if sample_pages and page_count > sample_pages:
+            with self.metrics.stage("stream_sample"):
+                statistics = self._sample_statistics(sample_pages)
+            self.metrics.count("sampled_statistics", statistics is not None)
+            if statistics is None:
+                print("Sampled statistics are not conclusive. Scanning every page...")
+
+        if statistics is not None:
+            self.header_footer_blacklist, body_font_size, body_font_color = statistics
+            self.body_style = {"size": body_font_size, "color": body_font_color}
+        else:
+            with self.metrics.stage("stream_pass_1"):
+                header_footer_candidates = Counter()
+                for page_idx in range(page_count):
+                    if not self.deadline.allows("pages"):
+                        break
+                    page = self.doc[page_idx]
+                    for line, line_text, _ in self._page_lines(page, count_words=False):
+                        normalized_text = self._header_footer_text(line, line_text, page.rect.height)
+                        if normalized_text:
+                            header_footer_candidates[normalized_text] += 1
+                self._make_blacklist(header_footer_candidates)
+                del header_footer_candidates
+
+        def is_blacklisted(line_text):
+            return re.sub(r'\d+', '', line_text).strip().lower() in self.header_footer_blacklist
+
+        if statistics is None:
+            with self.metrics.stage("stream_pass_2"):
+                font_sizes = Counter()
+                font_colors = Counter()
+                for page_idx in range(page_count):
+                    if not self.deadline.allows("pages"):
+                        break
+                    for _, line_text, main_span in self._page_lines(self.doc[page_idx], count_words=False):
+                        if not is_blacklisted(line_text):
+                            font_sizes[round(main_span["size"])] += 1
+                            font_colors[main_span["color"]] += 1
+            if font_sizes:
+                self._set_body_style(font_sizes, font_colors)
+
+        heading_sized = []
+        body_sized = []
+        if self.body_style:
+            with self.metrics.stage("stream_pass_3"):
+                line_count = 0
+                underline_pages = 0
+                underline_rects = 0
+                heading_sizes_seen = set()
+                for page_idx in range(page_count):
+                    if not self.deadline.allows("pages"):
+                        break
+                    page = self.doc[page_idx]
+
+                    page_blocks = block_store()
+                    for line, line_text, main_span in self._page_lines(page):
+                        line_count += 1
+                        if not is_blacklisted(line_text):
+                            page_blocks.append(
+                                self._block_info(line, line_text, main_span, page_idx + 1, page.rect.width))
+                    self._mark_underlines(page_blocks)
+                    underline_pages += len(self.underline_bboxes)
+                    underline_rects += sum(len(r) for r in self.underline_bboxes.values())
+                    heading_sizes_seen.update(s for s in page_blocks.font_size if s > self.body_style["size"])
+
+                    page_heading_sized, page_body_sized = self._score_store(page_blocks)
+                    heading_sized.extend(self._candidate_rows(page_blocks, page_heading_sized))
+                    body_sized.extend(self._candidate_rows(page_blocks, page_body_sized))
+            self.metrics.count("lines", line_count)
+            self.metrics.count("underline_pages", underline_pages)
+            self.metrics.count("underline_rects", underline_rects)
+
+            self.heading_font_sizes = sorted(heading_sizes_seen, reverse=True)
+            level_of_size = {size: f"H{i + 1}" for i, size in enumerate(self.heading_font_sizes)}
+            for heading in heading_sized:
+                heading["level"] = level_of_size[heading["font_size"]]
+            for heading in body_sized:
+                heading["level"] = f"H{len(self.heading_font_sizes) + 1}"
+
+        candidates = heading_sized
+        if not candidates:
+            print("No headings found. Retrying with body-sized text as potential headings...")
+            candidates = body_sized
+
+        return self._refine_candidates(candidates)
+
+
+# Once a cache directory outgrows its limit, eviction frees space down to this
+# share of it.
+CACHE_LOW_WATER = 0.9
+
+# This process's estimate of each cache directory's size, by path. Kept at
+# module level because cache objects are pickled afresh into every pool task.
+_cache_dir_bytes = {}
+
+
+class result_cache:
+    # On-disk cache of final {"output", "method"} results. Entries are keyed by
+    # the SHA-256 of the PDF bytes plus a fingerprint of everything that can
+    # change the result (extractor version and settings), so a hit never needs
+    # the document to be opened. Each entry is one small JSON file whose mtime
+    # doubles as its last-use time for LRU eviction.
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, pdf_bytes, settings=None):
+        fingerprint = json.dumps(
+            {"version": EXTRACTOR_VERSION, "ocr_lang": OCR_LANG, **DEFAULT_SETTINGS, **(settings or {})},
+            sort_keys=True)
+        settings_digest = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+        return f"{hashlib.sha256(pdf_bytes).hexdigest()}-{settings_digest}"
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as entry:
+                result = json.load(entry)
+            os.utime(entry_path)
+            return result
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, result):
+        self._evict(self._write(key, result))
+
+    def put_many(self, results):
+        # Several entries with a single eviction check at the end.
+        self._evict(sum(self._write(key, result) for key, result in results.items()))
+
+    def _write(self, key, result):
+        # Returns the number of bytes written. Every write gets its own temp
+        # file, so threads storing the same key (e.g. identical blank pages
+        # in one scan) never rename each other's file away.
+        import tempfile
+
+        data = json.dumps(result)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as entry:
+                entry.write(data)
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return len(data)
+
+    def _evict(self, written):
+        # The directory is only scanned when this process's running estimate
+        # of its size says it may have outgrown max_bytes (and once to start
+        # the estimate), not on every put. A scan then evicts down to
+        # CACHE_LOW_WATER of the limit, so the next one is far off. Writes
+        # from other workers are picked up by the next scan, so the limit
+        # may be overshot by a little while several processes write.
+        known_bytes = _cache_dir_bytes.get(self.cache_dir)
+        if known_bytes is not None and known_bytes + written <= self.max_bytes:
+            _cache_dir_bytes[self.cache_dir] = known_bytes + written
+            return
 
-        title = pdf.metadata.get('title', "No title found")
-        if not title:
-            title = "No title found"
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+        if total_bytes > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total_bytes <= self.max_bytes * CACHE_LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # already evicted by another worker
+                total_bytes -= size
+        _cache_dir_bytes[self.cache_dir] = total_bytes
+
+
+class page_feature_cache(result_cache):
+    # Per-page step_1 features (and underline rects, once a page has needed
+    # them) keyed by the page fingerprint from
+    # pdf_outline_extractor._page_fingerprint. A PDF re-issued with a few
+    # pages edited or appended only has those pages parsed again. The
+    # extractor and pymupdf versions are part of the key, since either can
+    # change what is extracted from the same page.
+
+    def make_key(self, fingerprint, kind="features"):
+        versions = f"{EXTRACTOR_VERSION}/{pymupdf.VersionBind}"
+        versions_digest = hashlib.sha256(versions.encode()).hexdigest()[:16]
+        return f"{fingerprint}-{kind}-{versions_digest}"
+
+
+class ndjson_sink:
+    # Appends one compact JSON line per document to rotating NDJSON files
+    # instead of writing one pretty-printed file per document. Each process
+    # owns its own file, so worker processes never share a file handle. A file
+    # is written as <name>.ndjson.part and renamed to <name>.ndjson once it is
+    # rotated or closed; readers only ever pick up complete files.
+
+    def __init__(self, directory, prefix="outlines", max_bytes=256 * 1024 * 1024, buffer_bytes=1024 * 1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.buffer_bytes = buffer_bytes
+        import socket
+
+        # Host, start time and pid keep file names unique when several nodes
+        # write to the same shared directory.
+        self.host = socket.gethostname()
+        self.started = time.strftime("%Y%m%dT%H%M%S")
+        self.sequence = 0
+        self.file = None
+        self.part_path = None
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        name = f"{self.prefix}-{self.host}-{self.started}-{os.getpid()}-{self.sequence:05d}.ndjson"
+        self.sequence += 1
+        self.part_path = os.path.join(self.directory, name + ".part")
+        self.file = open(self.part_path, 'wb', buffering=self.buffer_bytes)
+        self.written = 0
+
+    def write(self, source, output_data, method):
+        record = {"source": source, **output_data, "method": method}
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n").encode()
+        if self.file is None:
+            self._open()
+        self.file.write(line)
+        self.written += len(line)
+        if self.written >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        os.replace(self.part_path, self.part_path[:-len(".part")])
+        self.file = None
+        self.part_path = None
+
+    def close(self):
+        if self.file is not None:
+            self._rotate()
+
+
+_ndjson_sinks = {}
+
+
+def get_ndjson_sink(directory, max_bytes):
+    # One sink per process and directory. Pool workers are long-lived, so the
+    # sink is closed (and its last file renamed) when the process exits.
+    key = (os.getpid(), directory, max_bytes)
+    sink = _ndjson_sinks.get(key)
+    if sink is None:
+        from multiprocessing.util import Finalize
+
+        sink = _ndjson_sinks[key] = ndjson_sink(directory, max_bytes=max_bytes)
+        Finalize(None, sink.close, exitpriority=10)
+    return sink
+
+
+def close_ndjson_sinks():
+    for key, sink in list(_ndjson_sinks.items()):
+        if key[0] == os.getpid():
+            sink.close()
+            del _ndjson_sinks[key]
+
+
+OCR_LANG = 'eng+fra'
+
+# Image formats tesseract (through leptonica) decodes itself; anything else
+# pymupdf hands back is converted to PNG with Pillow first.
+TESSERACT_IMAGE_FORMATS = {"png", "jpg", "jpeg", "tif", "tiff", "bmp", "pnm", "pbm", "pgm", "ppm", "gif", "webp"}
+
+# Scanned pages are never rendered below this resolution, however many there
+# are; tesseract's accuracy drops off sharply under ~100 dpi.
+OCR_MIN_DPI = 100
+
+# OCR word heights are noisy, so line sizes are snapped to a geometric scale
+# (..., 9, 12, 15, 18, 23 pt). Body lines then share one size and only clearly
+# larger lines count as a heading size.
+OCR_SIZE_STEP = 1.25
+
+ocr_word = namedtuple("ocr_word", "block_num par_num line_num word_num left top width height conf text")
+
+
+def parse_tesseract_tsv(tsv_text):
+    # Keeps only recognised words (conf > 0, non-blank text) from tesseract's
+    # TSV output; the structural rows for pages, blocks and lines are dropped.
+    words = []
+    for row in tsv_text.splitlines():
+        fields = row.split('\t')
+        if len(fields) < 12 or fields[0] == 'level':
+            continue
+        text = fields[11].strip()
+        try:
+            conf = float(fields[10])
+        except ValueError:
+            continue
+        if conf <= 0 or not text:
+            continue
+        words.append(ocr_word(
+            block_num=int(fields[2]),
+            par_num=int(fields[3]),
+            line_num=int(fields[4]),
+            word_num=int(fields[5]),
+            left=int(fields[6]),
+            top=int(fields[7]),
+            width=int(fields[8]),
+            height=int(fields[9]),
+            conf=conf,
+            text=text,
+        ))
+    return words
+
+
+def group_ocr_blocks(ocr_words):
+    # Rebuilds tesseract's text blocks from the word records: lines joined by
+    # newlines in reading order, plus the average word height of the block.
+    blocks = {}
+    for word in ocr_words:
+        blocks.setdefault(word.block_num, []).append(word)
+
+    block_candidates = []
+    for block_num in sorted(blocks):
+        block_words = sorted(blocks[block_num], key=lambda w: (w.par_num, w.line_num, w.word_num))
+
+        lines_in_block = {}
+        for word in block_words:
+            lines_in_block.setdefault((word.par_num, word.line_num), []).append(word.text)
+        full_text = '\n'.join(' '.join(line) for line in lines_in_block.values())
+
+        block_candidates.append({
+            'text': full_text,
+            'avg_height': sum(w.height for w in block_words) / len(block_words),
+            'length': len(full_text)
+        })
+    return block_candidates
+
+
+def ocr_lines(ocr_words, scale):
+    # Yields (text, bbox, size, word_count) for each OCR line, with the bbox
+    # and the median word height converted to page points by `scale`.
+    lines = {}
+    for word in ocr_words:
+        lines.setdefault((word.block_num, word.par_num, word.line_num), []).append(word)
+
+    for key in sorted(lines):
+        words = sorted(lines[key], key=lambda w: w.word_num)
+        bbox = (
+            min(w.left for w in words) * scale,
+            min(w.top for w in words) * scale,
+            max(w.left + w.width for w in words) * scale,
+            max(w.top + w.height for w in words) * scale,
+        )
+        height = sorted(w.height for w in words)[len(words) // 2] * scale
+        size = round(OCR_SIZE_STEP ** round(math.log(height, OCR_SIZE_STEP))) if height > 0 else 0
+        yield " ".join(w.text for w in words), bbox, size, len(words)
+
+
+def ocr_render_dpi(page_rects, megapixels, max_dpi=300):
+    # Highest resolution at which all the pages together stay within
+    # `megapixels`. OCR time grows with the pixel count, so this keeps a long
+    # scan within the same latency budget as a short one.
+    area_sq_in = sum(rect.width * rect.height for rect in page_rects) / (72 * 72)
+    if area_sq_in <= 0:
+        return max_dpi
+    dpi = math.sqrt(megapixels * 1_000_000 / area_sq_in)
+    return int(max(OCR_MIN_DPI, min(max_dpi, dpi)))
+
+
+class ocr_engine:
+    # One OCR backend, reused through borrowed_ocr_engine(). With tesserocr
+    # installed the tesseract engine and its language models stay loaded
+    # between images; otherwise each image
+    # is piped straight into the tesseract binary and its TSV read back from
+    # stdout, with no temporary files and no DataFrame round trip.
+
+    def __init__(self, lang=OCR_LANG):
+        self.lang = lang
+        self.api = None
+        try:
+            import tesserocr
+        except ImportError:
+            import shutil
+            self.tesseract_cmd = shutil.which("tesseract")
+            if self.tesseract_cmd is None:
+                raise RuntimeError("tesseract is not installed or it's not in your PATH")
+        else:
+            self.api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    def image_to_words(self, image_bytes, image_ext):
+        from PIL import Image
+
+        if self.api is not None:
+            self.api.SetImage(Image.open(io.BytesIO(image_bytes)))
+            return parse_tesseract_tsv(self.api.GetTSVText(0))
+
+        if image_ext.lower() not in TESSERACT_IMAGE_FORMATS:
+            png = io.BytesIO()
+            Image.open(io.BytesIO(image_bytes)).save(png, format="PNG")
+            image_bytes = png.getvalue()
+
+        import subprocess
+        result = subprocess.run(
+            [self.tesseract_cmd, "stdin", "stdout", "-l", self.lang, "tsv"],
+            input=image_bytes, capture_output=True, check=True,
+        )
+        return parse_tesseract_tsv(result.stdout.decode("utf-8", errors="replace"))
+
+
+_idle_ocr_engines = queue.SimpleQueue()
+
+
+@contextmanager
+def borrowed_ocr_engine():
+    # Process-wide pool of warm engines. A tesserocr API object must only be
+    # used by one thread at a time, so each OCR call borrows an idle engine
+    # (loading a new one only when all are busy) and hands it back after, and
+    # the language models are loaded once per concurrently used engine for
+    # the life of the process, not per thread or per document.
+    try:
+        engine = _idle_ocr_engines.get_nowait()
+    except queue.Empty:
+        engine = ocr_engine()
+    try:
+        yield engine
+    finally:
+        _idle_ocr_engines.put(engine)
+
+
+class ocr_result_cache(result_cache):
+    # On-disk cache of recognised words per image. The same cover art, logos
+    # and letterheads recur across thousands of PDFs, so entries are keyed by
+    # the SHA-256 of the image bytes plus the OCR language and output format,
+    # never by the document they came from. Storage and LRU eviction work
+    # exactly as in result_cache.
+
+    def make_key(self, image_bytes, settings=None):
+        fingerprint = json.dumps({"ocr_lang": OCR_LANG, "format": "tsv", **(settings or {})}, sort_keys=True)
+        settings_digest = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+        return f"{hashlib.sha256(image_bytes).hexdigest()}-{settings_digest}"
+
+
+def ocr_image_words(image_bytes, image_ext, cache=None):
+    # image_to_words() through the optional ocr_result_cache: a repeated
+    # image is answered from disk without starting tesseract.
+    if cache is None:
+        with borrowed_ocr_engine() as engine:
+            return engine.image_to_words(image_bytes, image_ext)
+
+    key = cache.make_key(image_bytes)
+    cached_words = cache.get(key)
+    if cached_words is not None:
+        return [ocr_word(*word) for word in cached_words]
+
+    with borrowed_ocr_engine() as engine:
+        words = engine.image_to_words(image_bytes, image_ext)
+    try:
+        cache.put(key, words)
+    except OSError as e:
+        # The words are still good; only reusing them later is lost.
+        print(f"Could not store OCR result in cache: {e}")
+    return words
+
+
+def extraction_mode(settings, page_count):
+    # Which extractor entry point a document of page_count pages goes
+    # through: "streaming" (extract_streaming()) or "full" (extract()).
+    if settings["streaming_min_pages"] and page_count >= settings["streaming_min_pages"]:
+        return "streaming"
+    return "full"
+
+
+class document_stages:
+    # The per-document work as lazily evaluated stages. Each stage runs the
+    # first time an output asks for it and its result is memoised, so a PDF
+    # with a metadata title and an embedded TOC is finished after reading the
+    # trailer and the outline tree, and page 0 is never analysed twice.
+
+    def __init__(self, pdf, settings=None, metrics=None, ocr_cache=None, page_cache=None, page_features=None):
+        self.pdf = pdf
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.metrics = metrics if metrics is not None else document_metrics()
+        self.ocr_cache = ocr_cache
+        self.page_cache = page_cache
+        self.page_features = page_features
+        self.deadline = document_deadline(self.settings["deadline_s"])
+        self.title_method = ""
+        self.outline_method = ""
+
+    @cached_property
+    def metadata_title(self):
+        with self.metrics.stage("metadata"):
+            return (self.pdf.metadata or {}).get('title') or None
+
+    @cached_property
+    def toc(self):
+        with self.metrics.stage("toc"):
+            return self.pdf.get_toc()
+
+    @cached_property
+    def page_0_layout(self):
+        if self.pdf.page_count == 0:
+            return None
+        return page_layout(self.pdf[0])
+
+    @cached_property
+    def page_0_features(self):
+        layout = self.page_0_layout
+        if layout is None:
+            return None
+
+        page = layout.page
+        has_large_image_at_top = False
+
+        if not layout.is_empty:
+            top_zone = pymupdf.Rect(page.rect.x0, page.rect.y0, page.rect.x1, page.rect.height * 0.10)
+            page_area = page.rect.width * page.rect.height
+
+            has_large_image_at_top = any(
+                rect.intersects(top_zone) and 0.50 <= rect.width * rect.height / page_area < 0.97
+                for rect in layout.image_rects
+            )
 
-        output_data = {
-            "title": title,
-            "outline": []
+        return {
+            "page": page,
+            "needs_ocr": layout.is_empty or has_large_image_at_top,
         }
-        method_title = ""
-
-        if output_data['title'] == "No title found":
-            if pdf.page_count > 0:
-                page = pdf[0] # Renamed page_num to page for clarity
-
-                top_zone = pymupdf.Rect(page.rect.x0, page.rect.y0, page.rect.x1, page.rect.height * 0.10)
-                page_area = page.rect.width * page.rect.height
 
-                has_large_image_at_top = any(
-                    (pymupdf.Rect(img['bbox']).intersects(top_zone)) and
-                    ((pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) >= 0.50) and (
-                                (pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) < 0.97)
-                    for img in page.get_image_info()
-                )
+    @cached_property
+    def ocr_title(self):
+        page = self.page_0_features["page"]
 
-                if not page.get_text().strip() or has_large_image_at_top:
+        image_list = page.get_images(full=True)
+        if not image_list:
+            print("No images found on the first page to perform OCR.")
+            return None
 
-                    print("Page is either empty or has a large image at the top.")
+        image_list.sort(key=lambda img: img[0], reverse=True)
+        xref = image_list[0][0]
+        base_image = self.pdf.extract_image(xref)
 
-                    image_list = page.get_images(full=True)
-                    if image_list:
+        try:
+            ocr_words = ocr_image_words(base_image["image"], base_image["ext"], cache=self.ocr_cache)
+        except Exception as e:
+            print(f"An error occurred during OCR: {e}")
+            return None
 
-                        image_list.sort(key=lambda img: img[0], reverse=True)
-                        xref = image_list[0][0]
-                        base_image = pdf.extract_image(xref)
-                        image_bytes = base_image["image"]
+        if not ocr_words:
+            print("OCR did not return any usable data.")
+            return None
 
-                        try:
-                            image = Image.open(io.BytesIO(image_bytes))
-                            ocr_data = pytesseract.image_to_data(image, lang='eng+fra',
-                                                                 output_type=pytesseract.Output.DATAFRAME)
+        block_candidates = group_ocr_blocks(ocr_words)
+        if not block_candidates:
+            print("Could not reconstruct any blocks from OCR data.")
+            return None
 
-                            ocr_data = ocr_data[ocr_data.conf > 0]
-                            ocr_data['text'] = ocr_data['text'].astype(str).str.strip()
-                            ocr_data = ocr_data[ocr_data.text != '']
+        max_height = max(b['avg_height'] for b in block_candidates)
+        max_length = max(b['length'] for b in block_candidates)
 
-                            if not ocr_data.empty:
+        w_font = 0.7
+        w_len = 0.3
 
-                                blocks_grouped = ocr_data.groupby('block_num')
+        best_block = None
+        max_score = -1
+        for block in block_candidates:
+            font_score = block['avg_height'] / max_height if max_height > 0 else 0
+            len_score = block['length'] / max_length if max_length > 0 else 0
 
-                                block_candidates = []
-                                for block_num, block_df in blocks_grouped:
-                                    lines_in_block = \
-                                        block_df.sort_values(by=['par_num', 'line_num', 'word_num']).groupby(
-                                            ['par_num', 'line_num'])['text'].apply(' '.join)
-                                    full_text = '\n'.join(lines_in_block)
+            total_score = (w_font * font_score) + (w_len * len_score)
 
-                                    avg_height = block_df['height'].mean()
-                                    text_length = len(full_text)
+            if total_score > max_score:
+                max_score = total_score
+                best_block = block
 
-                                    block_candidates.append({
-                                        'text': full_text,
-                                        'avg_height': avg_height,
-                                        'length': text_length
-                                    })
+        if not best_block:
+            print("Could not determine a best block for the title.")
+            return None
 
-                                if block_candidates:
+        heuristic_title = " ".join(best_block['text'].split())
+        print(f"Title determined by block score heuristic: '{heuristic_title}'")
+        return heuristic_title
 
-                                    max_height = max(
-                                        b['avg_height'] for b in block_candidates) if block_candidates else 0
-                                    max_length = max(b['length'] for b in block_candidates) if block_candidates else 0
+    @cached_property
+    def text_title(self):
+        blocks = self.page_0_layout.blocks
 
-                                    w_font = 0.7
-                                    w_len = 0.3
+        if not blocks:
+            print("No text found on the first page.")
 
-                                    best_block = None
-                                    max_score = -1
-                                    for block in block_candidates:
-                                        font_score = block['avg_height'] / max_height if max_height > 0 else 0
-                                        len_score = block['length'] / max_length if max_length > 0 else 0
+        max_font_size = 0
+        title_block = None
 
-                                        total_score = (w_font * font_score) + (w_len * len_score)
+        for block in blocks:
+            if "lines" in block:
+                for line in block["lines"]:
+                    if "spans" in line:
+                        for span in line["spans"]:
+                            if span["size"] > max_font_size:
+                                max_font_size = span["size"]
+                                title_block = block
 
-                                        if total_score > max_score:
-                                            max_score = total_score
-                                            best_block = block
+        if title_block:
+            title_candidates = []
 
-                                    if best_block:
+            for line in title_block["lines"]:
+                if any(span["size"] == max_font_size for span in line["spans"]):
+                    for span in line["spans"]:
 
-                                        heuristic_title = " ".join(best_block['text'].split())
-                                        print(f"Title determined by block score heuristic: '{heuristic_title}'")
-                                        output_data['title'] = heuristic_title
-                                    else:
-                                        print("Could not determine a best block for the title.")
-                                else:
-                                    print("Could not reconstruct any blocks from OCR data.")
-                            else:
-                                print("OCR did not return any usable data.")
-
-                        except Exception as e:
-                            print(f"An error occurred during OCR: {e}")
-                    else:
-                        print("No images found on the first page to perform OCR.")
-                else:
+                        text_candidate = span["text"].strip()
+                        if text_candidate:
+                            title_candidates.append(text_candidate)
 
-                    blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
-
-                    if not blocks:
-                        print("No text found on the first page.")
-
-                    max_font_size = 0
-                    title_block = None
-
-                    for block in blocks:
-                        if "lines" in block:
-                            for line in block["lines"]:
-                                if "spans" in line:
-                                    for span in line["spans"]:
-                                        if span["size"] > max_font_size:
-                                            max_font_size = span["size"]
-                                            title_block = block
-
-                    if title_block:
-                        title_candidates = []
-
-                        for line in title_block["lines"]:
-                            if any(span["size"] == max_font_size for span in line["spans"]):
-                                for span in line["spans"]:
-
-                                    text_candidate = span["text"].strip()
-                                    if text_candidate:
-                                        title_candidates.append(text_candidate)
-
-                        if title_candidates:
-                            heuristic_title = " ".join(title_candidates)
-                            print('Title is determined heuristically')
-                            output_data['title'] = heuristic_title
-
-                    else:
-
-                        print("Could not determine title using font size")
+            if title_candidates:
+                heuristic_title = " ".join(title_candidates)
+                print('Title is determined heuristically')
+                return heuristic_title
 
         else:
-            method_title = "metadata"
-
-        toc = pdf.get_toc()
-        if toc:
 
-            outline_method = "toc"
+            print("Could not determine title using font size")
+        return None
+
+    @cached_property
+    def title(self):
+        if self.metadata_title:
+            self.title_method = "metadata"
+            return self.metadata_title
+
+        with self.metrics.stage("title_page_0"):
+            features = self.page_0_features
+
+        title = None
+        if features is not None:
+            if features["needs_ocr"]:
+                print("Page is either empty or has a large image at the top.")
+                if self.deadline.allows("ocr"):
+                    with self.metrics.stage("ocr"):
+                        title = self.ocr_title
+                    self.title_method = "ocr"
+            else:
+                with self.metrics.stage("title_heuristic"):
+                    title = self.text_title
+                self.title_method = "heuristic"
 
-            for entry in toc:
-                level, title, page_num = entry # Changed 'page' to 'page_num' to match desired output
-                outline_pdf = {
+        if not title:
+            self.title_method = "none"
+        return title or "No title found"
+
+    @cached_property
+    def extractor(self):
+        return pdf_outline_extractor(pdf_doc=self.pdf,
+                                     max_heading_word_percentage=self.settings["max_heading_word_percentage"],
+                                     metrics=self.metrics,
+                                     ocr_megapixels=self.settings["ocr_megapixels"],
+                                     ocr_max_dpi=self.settings["ocr_max_dpi"],
+                                     ocr_threads=self.settings["ocr_threads"],
+                                     ocr_cache=self.ocr_cache,
+                                     deadline=self.deadline,
+                                     page_cache=self.page_cache,
+                                     layouts={0: self.page_0_layout} if self.page_0_layout else None)
+
+    @cached_property
+    def heuristic_outline(self):
+        if extraction_mode(self.settings, self.pdf.page_count) == "streaming":
+            return self.extractor.extract_streaming(sample_pages=self.settings["sample_pages"])
+        return self.extractor.extract(self.page_features)
+
+    @cached_property
+    def outline(self):
+        if self.toc:
+            self.outline_method = "toc"
+            return [
+                {
                     "level": f"H{level}",
                     "text": title,
-                    "page_num": page_num, # Changed to page_num
+                    "page_num": page_num,
                 }
+                for level, title, page_num in self.toc
+            ]
 
-                output_data["outline"].append(outline_pdf)
+        self.outline_method = 'heuristic'
+        print("TOC not found. Using heuristic model to extract outline...")
+        return self.heuristic_outline
+
+
+def extract_document(pdf, settings=None, metrics=None, ocr_cache=None, page_cache=None, page_features=None):
+    # Returns (output_data, method); method records how the title and the
+    # outline were found, e.g. {"title": "metadata", "outline": "heuristic"}.
+    stages = document_stages(pdf, settings=settings, metrics=metrics, ocr_cache=ocr_cache, page_cache=page_cache,
+                             page_features=page_features)
+
+    output_data = {
+        "title": stages.title,
+        "outline": stages.outline,
+    }
+    method = {"title": stages.title_method, "outline": stages.outline_method}
+    if stages.deadline.degraded:
+        # Present only when the deadline cut the work short, listing what was
+        # skipped in the order it happened.
+        output_data["degraded"] = list(stages.deadline.degraded)
+
+    return output_data, method
+
+
+def _output_json_path(pdf_path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(pdf_path))[0] + '.json')
+
+
+def process_pdf(pdf_path, output_dir, cache=None, settings=None, metrics_sidecar=False, metrics_file=None,
+                ndjson_dir=None, ndjson_max_mb=256, pdf_bytes=None, writer=None, ocr_cache=None, page_cache=None,
+                page_features=None):
+    pdf_name = os.path.basename(pdf_path)
+    print(f"Processing {pdf_name}...")
+
+    metrics = document_metrics(source=pdf_name)
+    deadline_s = {**DEFAULT_SETTINGS, **(settings or {})}["deadline_s"]
+    error = None
+    try:
+        with metrics.stage("total"), document_watchdog(deadline_s * WATCHDOG_GRACE):
+            sink = get_ndjson_sink(ndjson_dir, int(ndjson_max_mb * 1024 * 1024)) if ndjson_dir else None
+            _process_pdf(pdf_path, output_dir, metrics, cache=cache, settings=settings, sink=sink,
+                         pdf_bytes=pdf_bytes, writer=writer, ocr_cache=ocr_cache, page_cache=page_cache,
+                         page_features=page_features)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if metrics_sidecar or metrics_file:
+            if writer is not None:
+                writer.submit(pdf_path, write_metrics, metrics, output_dir, sidecar=metrics_sidecar,
+                              metrics_file=metrics_file, error=error)
+            else:
+                write_metrics(metrics, output_dir, sidecar=metrics_sidecar, metrics_file=metrics_file, error=error)
+
+
+def _process_pdf(pdf_path, output_dir, metrics, cache=None, settings=None, sink=None, pdf_bytes=None,
+                 writer=None, ocr_cache=None, page_cache=None, page_features=None):
+    # pdf_bytes may already have been read by prefetch_pdfs(); with a writer
+    # the output is handed to its background thread instead of written here.
+    # page_features are the merged results of page-range subtasks, if the
+    # document was split (see run_batch).
+    if pdf_bytes is None:
+        with metrics.stage("read"):
+            with open(pdf_path, 'rb') as pdf_file:
+                pdf_bytes = pdf_file.read()
+    metrics.count("bytes", len(pdf_bytes))
+
+    result = None
+    if cache is not None:
+        with metrics.stage("cache_lookup"):
+            cache_key = cache.make_key(pdf_bytes, settings)
+            result = cache.get(cache_key)
+        metrics.count("cache_hit", result is not None)
+        if result is not None:
+            print("Result found in cache")
+
+    if result is None:
+        with metrics.stage("open"):
+            pdf = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            metrics.count("pages", pdf.page_count)
+            if page_features:
+                metrics.count("page_ranges", len(page_features))
+            output_data, method = extract_document(pdf, settings=settings, metrics=metrics, ocr_cache=ocr_cache,
+                                                   page_cache=page_cache, page_features=page_features)
+        finally:
+            pdf.close()
+        result = {"output": output_data, "method": method}
+
+        # A result cut short by the deadline is not worth keeping.
+        if cache is not None and "degraded" not in output_data:
+            cache.put(cache_key, result)
+
+    output_data = result["output"]
+    with metrics.stage("write"):
+        if writer is not None:
+            writer.submit(pdf_path, _write_output, pdf_path, output_dir, result, sink)
         else:
+            _write_output(pdf_path, output_dir, result, sink)
+    metrics.count("outline_entries", len(output_data["outline"]))
+    metrics.count("degraded", output_data.get("degraded", []))
+
+    if sink is None:
+        print("successfully creates output.json")
 
-            outline_method = 'heuristic'
-            print("TOC not found. Using heuristic model to extract outline...")
-            extractor = pdf_outline_extractor(pdf_doc=pdf)
-            heuristic_outline = extractor.extract()
-            output_data["outline"] = heuristic_outline
 
-        json_filename = os.path.join(output_dir, os.path.splitext(pdf_name)[0] + '.json')
+def _write_output(pdf_path, output_dir, result, sink=None):
+    if sink is not None:
+        sink.write(os.path.basename(pdf_path), result["output"], result["method"])
+    else:
+        json_filename = _output_json_path(pdf_path, output_dir)
         with open(json_filename, 'w') as json_output:
-            json.dump(output_data, json_output, indent=4)
+            json.dump(result["output"], json_output, indent=4)
+
+
+def prefetch_pdfs(pdf_paths, depth=2):
+    # Yields (pdf_path, pdf_bytes, error) in order while a reader thread
+    # already loads the next `depth` files, so slow (e.g. network-mounted)
+    # volumes are read while the previous document is being parsed. At most
+    # depth + 1 documents are held in memory ahead of the consumer.
+    def read(pdf_path):
+        try:
+            with open(pdf_path, 'rb') as pdf_file:
+                return pdf_path, pdf_file.read(), None
+        except OSError as e:
+            return pdf_path, None, f"{type(e).__name__}: {e}"
+
+    if depth <= 0:
+        yield from map(read, pdf_paths)
+        return
+
+    pending = queue.Queue(maxsize=depth)
+
+    def reader():
+        for pdf_path in pdf_paths:
+            pending.put(read(pdf_path))
+
+    threading.Thread(target=reader, daemon=True).start()
+    for _ in pdf_paths:
+        yield pending.get()
+
+
+class background_writer:
+    # Runs output writes on one background thread, in submission order, so
+    # the extraction loop never waits on the disk. The queue is bounded to
+    # keep memory flat if the disk falls behind. Failed writes are collected
+    # per PDF and returned by close().
+
+    def __init__(self, max_pending=64):
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, pdf_path, func, *args, **kwargs):
+        self.pending.put((pdf_path, func, args, kwargs))
+
+    def _run(self):
+        while True:
+            task = self.pending.get()
+            if task is None:
+                return
+            pdf_path, func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors.append((pdf_path, f"{type(e).__name__}: {e}"))
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        return self.errors
+
+
+def write_metrics(metrics, output_dir, sidecar=False, metrics_file=None, error=None):
+    record = metrics.to_dict()
+    record["error"] = error
+
+    if sidecar:
+        sidecar_filename = os.path.join(output_dir, os.path.splitext(metrics.source)[0] + '.metrics.json')
+        with open(sidecar_filename, 'w') as sidecar_output:
+            json.dump(record, sidecar_output, indent=4)
+
+    if metrics_file:
+        # One line per document, appended with a single write so records from
+        # concurrent worker processes never interleave.
+        line = (json.dumps(record) + "\n").encode()
+        fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def _process_pdf_safely(pdf_path, output_dir, **options):
+    # Runs inside a pool worker: a broken PDF is reported back instead of
+    # raising, so one bad document never takes the rest of the batch down.
+    try:
+        process_pdf(pdf_path, output_dir, **options)
+        return pdf_path, None
+    except Exception as e:
+        return pdf_path, f"{type(e).__name__}: {e}"
+
+
+def estimate_cost(pdf_path, settings=None):
+    # A cheap guess at how long a PDF takes, in text-page equivalents, from its
+    # file size, page count, outline tree and page 0, without parsing any
+    # other page. Returns (cost, page_count, has_toc). A PDF with a TOC only
+    # has its title to find; one whose page 0 carries no text is taken to be
+    # scanned throughout. A PDF that doesn't open is left to fail in its
+    # worker and costs its size alone.
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    try:
+        size_cost = os.path.getsize(pdf_path) / (1024 * 1024) * COST_PER_MB
+        pdf = pymupdf.open(pdf_path)
+    except Exception:
+        return 0.0, 0, False
+
+    try:
+        page_count = pdf.page_count
+        has_toc = bool(pdf.get_toc())
+        if has_toc or page_count == 0:
+            page_cost = 1
+        elif settings["ocr_megapixels"] and page_layout(pdf[0]).is_empty:
+            page_cost = page_count * OCR_PAGE_COST
+        else:
+            page_cost = page_count
+    except Exception:
+        return size_cost, 0, False
+    finally:
+        pdf.close()
+    return page_cost + size_cost, page_count, has_toc
 
-        print("successfully creates output.json")
-        
-        # if method_title == "metadata":
-        #     feedback_title = input(" Type satisfied/not satisfied for title ")
-        #     if feedback_title == "satisfied":
-        #         pass
-        #     else:
-        #         page = pdf[0]
-        #
-        #         top_zone = pymupdf.Rect(page.rect.x0, page.rect.y0, page.rect.x1, page.rect.height * 0.10)
-        #         page_area = page.rect.width * page.rect.height
-        #
-        #         has_large_image_at_top = any(
-        #             (pymupdf.Rect(img['bbox']).intersects(top_zone)) and
-        #             ((pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) >= 0.50) and (
-        #                     (pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) < 0.97)
-        #             for img in page.get_image_info()
-        #         )
-        #
-        #         if not page.get_text().strip() or has_large_image_at_top:
-        #
-        #             print("Page is either empty or has a large image at the top.")
-        #
-        #             image_list = page.get_images(full=True)
-        #             if image_list:
-        #
-        #                 image_list.sort(key=lambda img: img[0], reverse=True)
-        #                 xref = image_list[0][0]
-        #                 base_image = pdf.extract_image(xref)
-        #                 image_bytes = base_image["image"]
-        #
-        #                 try:
-        #                     image = Image.open(io.BytesIO(image_bytes))
-        #                     ocr_data = pytesseract.image_to_data(image, lang='eng+fra',
-        #                                                          output_type=pytesseract.Output.DATAFRAME)
-        #
-        #                     ocr_data = ocr_data[ocr_data.conf > 0]
-        #                     ocr_data['text'] = ocr_data['text'].astype(str).str.strip()
-        #                     ocr_data = ocr_data[ocr_data.text != '']
-        #
-        #                     if not ocr_data.empty:
-        #
-        #                         blocks_grouped = ocr_data.groupby('block_num')
-        #
-        #                         block_candidates = []
-        #                         for block_num, block_df in blocks_grouped:
-        #                             lines_in_block = \
-        #                                 block_df.sort_values(by=['par_num', 'line_num', 'word_num']).groupby(
-        #                                     ['par_num', 'line_num'])['text'].apply(' '.join)
-        #                             full_text = '\n'.join(lines_in_block)
-        #
-        #                             avg_height = block_df['height'].mean()
-        #                             text_length = len(full_text)
-        #
-        #                             block_candidates.append({
-        #                                 'text': full_text,
-        #                                 'avg_height': avg_height,
-        #                                 'length': text_length
-        #                             })
-        #
-        #                         if block_candidates:
-        #
-        #                             max_height = max(
-        #                                 b['avg_height'] for b in block_candidates) if block_candidates else 0
-        #                             max_length = max(b['length'] for b in block_candidates) if block_candidates else 0
-        #
-        #                             w_font = 0.7
-        #                             w_len = 0.3
-        #
-        #                             best_block = None
-        #                             max_score = -1
-        #                             for block in block_candidates:
-        #                                 font_score = block['avg_height'] / max_height if max_height > 0 else 0
-        #                                 len_score = block['length'] / max_length if max_length > 0 else 0
-        #
-        #                                 total_score = (w_font * font_score) + (w_len * len_score)
-        #
-        #                                 if total_score > max_score:
-        #                                     max_score = total_score
-        #                                     best_block = block
-        #
-        #                             if best_block:
-        #
-        #                                 heuristic_title = " ".join(best_block['text'].split())
-        #                                 print(f"Title determined by block score heuristic: '{heuristic_title}'")
-        #                                 output_data['title'] = heuristic_title
-        #                             else:
-        #                                 print("Could not determine a best block for the title.")
-        #                         else:
-        #                             print("Could not reconstruct any blocks from OCR data.")
-        #                     else:
-        #                         print("OCR did not return any usable data.")
-        #
-        #                 except Exception as e:
-        #                     print(f"An error occurred during OCR: {e}")
-        #             else:
-        #                 print("No images found on the first page to perform OCR.")
-        #         else:
-        #
-        #             blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
-        #
-        #             if not blocks:
-        #                 print("No text found on the first page.")
-        #
-        #             max_font_size = 0
-        #             title_block = None
-        #
-        #             for block in blocks:
-        #                 if "lines" in block:
-        #                     for line in block["lines"]:
-        #                         if "spans" in line:
-        #                             for span in line["spans"]:
-        #                                 if span["size"] > max_font_size:
-        #                                     max_font_size = span["size"]
-        #                                     title_block = block
-        #
-        #             if title_block:
-        #                 title_candidates = []
-        #
-        #                 for line in title_block["lines"]:
-        #                     if any(span["size"] == max_font_size for span in line["spans"]):
-        #                         for span in line["spans"]:
-        #
-        #                             text_candidate = span["text"].strip()
-        #                             if text_candidate:
-        #                                 title_candidates.append(text_candidate)
-        #
-        #                 if title_candidates:
-        #                     heuristic_title = " ".join(title_candidates)
-        #                     print('Title is determined heuristically')
-        #                     output_data['title'] = heuristic_title
-        #
-        #             else:
-        #
-        #                 print("Could not determine title using font size")
-        #
-        #     json_filename = os.path.join(output_dir, os.path.splitext(pdf_name)[0] + '.json')
-        #
-        #     with open(json_filename, 'w') as json_output:
-        #         json.dump(output_data, json_output, indent=4)
-        #
-        #     print("successfully creates ouput.json")
 
-        # if outline_method == "toc":
-        #     feedback_outline = input(" type satisfied/ not satified with outline ")
-        #     if feedback_outline == "satisfied":
-        #         print("thank you for using our tool")
-        #     else:
-        #
-        #         extractor = pdf_outline_extractor(pdf_doc=pdf)
-        #         heuristic_outline = extractor.extract()
-        #         output_data["outline"] = heuristic_outline
-        #
-        #         json_filename = os.path.join(output_dir, os.path.splitext(pdf_name)[0] + '.json')
-        #
-        #         with open(json_filename, 'w') as json_output:
-        #             json.dump(output_data, json_output, indent=4)
-        #
-        #     print("successfully creates output.json")
-        #     print("thank you for using our tool")
-        #
-        # page = pdf[0]
-        # top_zone = pymupdf.Rect(page.rect.x0, page.rect.y0, page.rect.x1, page.rect.height * 0.10)
-        # page_area = page.rect.width * page.rect.height
-        #
-        # has_large_image_at_top = any(
-        #     (pymupdf.Rect(img['bbox']).intersects(top_zone)) and
-        #     ((pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) >= 0.50) and (
-        #             (pymupdf.Rect(img['bbox']).width * pymupdf.Rect(img['bbox']).height / page_area) < 0.97)
-        #     for img in page.get_image_info()
-        # )
-        #
-        # if pdf.page_count == 1 and has_large_image_at_top:
-        #     output_data["outline"] = []
-        #     json_filename = os.path.join(output_dir, os.path.splitext(pdf_name)[0] + '.json')
-        #
-        #     with open(json_filename, 'w') as json_output:
-        #         json.dump(output_data, json_output, indent=4)
+def _extract_page_range(pdf_path, start, stop, settings=None, ocr_cache=None, page_cache=None):
+    # Pool task: the per-page text parsing of step_1 for pages [start, stop)
+    # of one PDF, merged by the document's own task once every range is done.
+    deadline_s = {**DEFAULT_SETTINGS, **(settings or {})}["deadline_s"]
+    with document_watchdog(deadline_s * WATCHDOG_GRACE):
+        pdf = pymupdf.open(pdf_path)
+        try:
+            stages = document_stages(pdf, settings=settings, ocr_cache=ocr_cache, page_cache=page_cache)
+            return stages.extractor.collect_page_features(start, stop)
+        finally:
+            pdf.close()
+
+
+def _plan_document(pdf_path, split_pages=0, settings=None, cache=None):
+    # Pool task run ahead of the batch: (cost, page_ranges) of one PDF, with
+    # page_ranges [(start, stop), ...] if the document is worth splitting, else
+    # None. Only documents that go through the full extract() are split: a
+    # TOC makes the page scan unnecessary and streaming extraction keeps its
+    # own bounded passes. A document with a cached result isn't split either.
+    cost, page_count, has_toc = estimate_cost(pdf_path, settings)
+    if not split_pages or page_count <= split_pages or has_toc:
+        return cost, None
+    if extraction_mode({**DEFAULT_SETTINGS, **(settings or {})}, page_count) != "full":
+        return cost, None
+    if cache is not None:
+        try:
+            with open(pdf_path, 'rb') as pdf_file:
+                if cache.get(cache.make_key(pdf_file.read(), settings)) is not None:
+                    return cost, None
+        except OSError:
+            return cost, None
+    return cost, [(start, min(start + split_pages, page_count)) for start in range(0, page_count, split_pages)]
+
+
+def run_batch(input_dir, output_dir, workers=1, prefetch=2, schedule="name", split_pages=0, **options):
+    # schedule orders the documents by estimate_cost(): "largest-first" keeps
+    # one big PDF from being started last and holding up the end of the batch,
+    # "shortest-first" gets most outputs out soonest, "name" keeps directory
+    # order. With several workers, documents longer than split_pages are
+    # also split into page-range tasks so one long PDF can use every worker.
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+    from functools import partial
+    from itertools import repeat
+
+    pdf_paths = [
+        os.path.join(input_dir, pdf_name)
+        for pdf_name in sorted(os.listdir(input_dir))
+        if pdf_name.lower().endswith(".pdf")
+    ]
+    os.makedirs(output_dir, exist_ok=True)
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    # Worker processes are only started as tasks are submitted, so a batch
+    # that turns out to need fewer never starts the rest.
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+        plans = {}
+        if schedule != "name" or (split_pages and executor is not None):
+            # Opening every PDF to estimate it is spread over the pool too.
+            plan_map = executor.map if executor is not None else map
+            try:
+                plans = dict(zip(pdf_paths, plan_map(_plan_document, pdf_paths,
+                                                     repeat(split_pages if executor is not None else 0),
+                                                     repeat(options.get("settings")), repeat(options.get("cache")))))
+            except Exception as e:
+                # A worker crashed opening some PDF; that PDF fails again later.
+                print(f"Could not plan the batch, keeping name order: {type(e).__name__}: {e}")
+                if executor is not None:
+                    executor.shutdown()
+                    executor = ProcessPoolExecutor(max_workers=workers)
+        if plans and schedule != "name":
+            pdf_paths.sort(key=lambda pdf_path: plans[pdf_path][0], reverse=schedule == "largest-first")
+
+        # Tasks are (pdf_path, page_range); page_range None processes the whole
+        # document, with the merged page ranges if it was split. The pool is
+        # sized by tasks rather than PDFs, so a single long PDF still gets its
+        # workers.
+        tasks = deque()
+        parts = {}          # pdf_path -> {start: features} of a split document
+        for pdf_path in pdf_paths:
+            _, ranges = plans.get(pdf_path, (0, None))
+            if ranges:
+                parts[pdf_path] = {}
+                tasks.extend((pdf_path, page_range) for page_range in ranges)
+            else:
+                tasks.append((pdf_path, None))
+        workers = min(workers, len(tasks)) or 1
+
+        failures = []
+        if workers == 1:
+            # Reading the next PDFs and writing the finished outputs both
+            # happen on background threads, so this loop only ever parses.
+            writer = background_writer()
+            for pdf_path, pdf_bytes, error in prefetch_pdfs(pdf_paths, depth=prefetch):
+                if error is None:
+                    _, error = _process_pdf_safely(pdf_path, output_dir, pdf_bytes=pdf_bytes, writer=writer,
+                                                   **options)
+                if error:
+                    print(f"Failed to process {os.path.basename(pdf_path)}: {error}")
+                    failures.append(pdf_path)
+            for pdf_path, error in writer.close():
+                print(f"Failed to write output of {os.path.basename(pdf_path)}: {error}")
+                if pdf_path not in failures:
+                    failures.append(pdf_path)
+        else:
+            # Only `workers` tasks are submitted at a time so the pool runs them
+            # in this order, and a split document's final task jumps the queue
+            # as soon as its last range is done.
+            remaining = Counter(pdf_path for pdf_path, page_range in tasks if page_range is not None)
+
+            split_note = f", {len(parts)} of them split into page ranges" if parts else ""
+            print(f"Processing {len(pdf_paths)} PDFs with {workers} worker processes{split_note}...")
+            in_flight = {}      # future -> (pdf_path, page_range)
+            suspects = set()    # tasks in flight when a worker crashed
+            while tasks or in_flight:
+                # A suspect task only runs alone, so a crash while it is in
+                # flight is its own.
+                while tasks and len(in_flight) < workers and not suspects & set(in_flight.values()):
+                    pdf_path, page_range = task = tasks[0]
+                    if pdf_path in failures:
+                        tasks.popleft()
+                        continue
+                    if task in suspects and in_flight:
+                        break
+                    tasks.popleft()
+                    if page_range is None:
+                        run = partial(_process_pdf_safely, pdf_path, output_dir,
+                                      page_features=parts.get(pdf_path), **options)
+                    else:
+                        run = partial(_extract_page_range, pdf_path, *page_range,
+                                      settings=options.get("settings"), ocr_cache=options.get("ocr_cache"),
+                                      page_cache=options.get("page_cache"))
+                    try:
+                        future = executor.submit(run)
+                    except BrokenProcessPool:
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                        future = executor.submit(run)
+                    in_flight[future] = task
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pdf_path, page_range = task = in_flight.pop(future)
+                    error = None
+                    try:
+                        if page_range is None:
+                            _, error = future.result()
+                        else:
+                            features = future.result()
+                    except BrokenProcessPool as e:
+                        # A worker died (e.g. a crash inside MuPDF) and took
+                        # every task in flight down with it. Each is retried
+                        # alone on a new pool; one that crashes alone failed.
+                        if task not in suspects:
+                            suspects.add(task)
+                            tasks.appendleft(task)
+                            continue
+                        error = f"worker crashed: {type(e).__name__}: {e}"
+                    except Exception as e:
+                        # A page range failed.
+                        error = f"{type(e).__name__}: {e}"
+                    suspects.discard(task)
+                    if error:
+                        if pdf_path not in failures:
+                            print(f"Failed to process {os.path.basename(pdf_path)}: {error}")
+                            failures.append(pdf_path)
+                        parts.pop(pdf_path, None)
+                        continue
+                    if page_range is None:
+                        parts.pop(pdf_path, None)
+                    elif pdf_path in parts:
+                        parts[pdf_path][page_range[0]] = features
+                        remaining[pdf_path] -= 1
+                        if not remaining[pdf_path]:
+                            parts[pdf_path] = [parts[pdf_path][start] for start in sorted(parts[pdf_path])]
+                            tasks.appendleft((pdf_path, None))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    close_ndjson_sinks()
+    print(f"Processed {len(pdf_paths) - len(failures)}/{len(pdf_paths)} PDFs successfully")
+    return failures
+
+
+def _scan_pdfs(input_dir):
+    # {pdf_path: (size, mtime)} for every PDF currently in input_dir.
+    pdfs = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".pdf") and entry.is_file():
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                pdfs[entry.path] = (stat.st_size, stat.st_mtime)
+    return pdfs
+
+
+def _is_up_to_date(pdf_path, pdf_mtime, output_dir):
+    try:
+        return os.stat(_output_json_path(pdf_path, output_dir)).st_mtime >= pdf_mtime
+    except OSError:
+        return False
+
+
+def watch_directory(input_dir, output_dir, workers=1, poll_interval=2.0, settle_seconds=2.0,
+                    max_queue=64, **options):
+    # Processes PDFs as they appear in input_dir, and again when they change.
+    # A PDF is only picked up when its output JSON is missing or older than
+    # the PDF, and only once its size and mtime have stayed the same for
+    # settle_seconds, so files still being copied in are left alone. At most
+    # workers + max_queue documents are in flight; the rest wait on disk
+    # until a later pass. With the optional `watchdog` package, filesystem
+    # events wake the loop early; otherwise it polls every poll_interval.
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    os.makedirs(output_dir, exist_ok=True)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    wake_up = threading.Event()
+    observer = None
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        print(f"Watching {input_dir} by polling every {poll_interval}s")
+    else:
+        class wake_on_change(FileSystemEventHandler):
+            def on_any_event(self, event):
+                wake_up.set()
+
+        observer = Observer()
+        observer.schedule(wake_on_change(), input_dir, recursive=False)
+        observer.start()
+        print(f"Watching {input_dir} for filesystem events")
+
+    last_seen = {}      # pdf_path -> ((size, mtime), time the signature was first seen)
+    failed = {}         # pdf_path -> mtime of the version that failed
+    in_flight = {}      # future -> (pdf_path, mtime)
+    suspects = set()    # pdf_paths in flight when a worker crashed
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for future in [f for f in in_flight if f.done()]:
+                pdf_path, pdf_mtime = in_flight.pop(future)
+                try:
+                    _, error = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died (a MuPDF segfault, an OOM kill) and took
+                    # every document in flight down with it. Each is retried
+                    # alone on a new pool; one that crashes alone failed.
+                    if pdf_path not in suspects:
+                        suspects.add(pdf_path)
+                        continue
+                    error = f"worker crashed: {type(e).__name__}: {e}"
+                except Exception as e:
+                    error = f"worker crashed: {type(e).__name__}: {e}"
+                suspects.discard(pdf_path)
+                if error:
+                    print(f"Failed to process {os.path.basename(pdf_path)}: {error}")
+                    failed[pdf_path] = pdf_mtime
+
+            now = time.monotonic()
+            busy = {pdf_path for pdf_path, _ in in_flight.values()}
+            current = _scan_pdfs(input_dir)
+            for pdf_path in list(last_seen):
+                if pdf_path not in current:
+                    del last_seen[pdf_path]
+
+            for pdf_path, signature in sorted(current.items()):
+                if len(in_flight) >= workers + max_queue or busy & suspects:
+                    break
+                pdf_mtime = signature[1]
+                if pdf_path in busy or failed.get(pdf_path) == pdf_mtime:
+                    continue
+                if pdf_path in suspects and in_flight:
+                    continue
+                if _is_up_to_date(pdf_path, pdf_mtime, output_dir):
+                    continue
+
+                seen_signature, first_seen = last_seen.get(pdf_path, (None, now))
+                if seen_signature != signature:
+                    last_seen[pdf_path] = (signature, now)
+                    continue
+                if now - first_seen < settle_seconds:
+                    continue
+
+                try:
+                    future = executor.submit(_process_pdf_safely, pdf_path, output_dir, **options)
+                except BrokenProcessPool:
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                    future = executor.submit(_process_pdf_safely, pdf_path, output_dir, **options)
+                in_flight[future] = (pdf_path, pdf_mtime)
+                busy.add(pdf_path)
+
+            wake_up.wait(min(poll_interval, settle_seconds) if last_seen or in_flight else poll_interval)
+            wake_up.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+        executor.shutdown(cancel_futures=True)
+
+
+class shard_claims:
+    # Lets several nodes share one input directory with no central service.
+    # All coordination happens through marker files in claims_dir:
+    #   <name>.claim   created with O_CREAT|O_EXCL, so only one node can hold
+    #                  it; its mtime is refreshed while the node works on it
+    #   <name>.done    written when the PDF is finished (.failed on error),
+    #                  before the claim is removed
+    # A claim not refreshed for lease_seconds belongs to a node that died.
+    # Another node takes it over by renaming it away, which only one of them
+    # can win. Ages are measured against the mtime of this node's own
+    # .<node>.alive file, so clocks on different machines need not agree.
+
+    def __init__(self, claims_dir, lease_seconds=120):
+        import socket
+
+        self.claims_dir = claims_dir
+        self.lease_seconds = lease_seconds
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.alive_path = os.path.join(claims_dir, f".{self.node_id}.alive")
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(claims_dir, exist_ok=True)
+
+    def _path(self, pdf_path, suffix):
+        return os.path.join(self.claims_dir, os.path.basename(pdf_path) + suffix)
+
+    def _now(self):
+        # Current time as the shared filesystem sees it.
+        with open(self.alive_path, 'a'):
+            pass
+        os.utime(self.alive_path)
+        return os.stat(self.alive_path).st_mtime
+
+    def is_finished(self, pdf_path, pdf_mtime):
+        for suffix in (".done", ".failed"):
+            try:
+                if os.stat(self._path(pdf_path, suffix)).st_mtime >= pdf_mtime:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def try_claim(self, pdf_path, pdf_mtime):
+        claim_path = self._path(pdf_path, ".claim")
+        try:
+            fd = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if not self._take_over_expired(claim_path):
+                return False
+            try:
+                fd = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, 'w') as claim:
+            claim.write(f"{self.node_id}\n")
+
+        # Another node may have finished it after this one listed the directory.
+        if self.is_finished(pdf_path, pdf_mtime):
+            os.remove(claim_path)
+            return False
+        with self.lock:
+            self.held.add(claim_path)
+        return True
+
+    def _take_over_expired(self, claim_path):
+        now = self._now()
+        expired_path = f"{claim_path}.expired.{self.node_id}"
+        try:
+            if now - os.stat(claim_path).st_mtime < self.lease_seconds:
+                return False
+            os.rename(claim_path, expired_path)
+        except OSError:
+            return False
+
+        # The owner may have refreshed the claim between the stat and the
+        # rename; in that case it is still alive and gets its claim back.
+        if now - os.stat(expired_path).st_mtime < self.lease_seconds:
+            try:
+                os.link(expired_path, claim_path)
+            except OSError:
+                pass
+            os.remove(expired_path)
+            return False
+
+        os.remove(expired_path)
+        print(f"Taking over expired claim on {os.path.basename(claim_path)[:-len('.claim')]}")
+        return True
+
+    def finish(self, pdf_path, error=None):
+        marker_path = self._path(pdf_path, ".failed" if error else ".done")
+        with open(marker_path, 'w') as marker:
+            marker.write(f"{self.node_id}\t{error or ''}\n")
+        self.release(pdf_path)
+
+    def release(self, pdf_path):
+        claim_path = self._path(pdf_path, ".claim")
+        with self.lock:
+            self.held.discard(claim_path)
+        try:
+            os.remove(claim_path)
+        except OSError:
+            pass
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            for claim_path in held:
+                try:
+                    os.utime(claim_path)
+                except OSError:
+                    print(f"Lost claim {os.path.basename(claim_path)}; another node may be processing it too")
+
+    def start(self):
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            held = list(self.held)
+        for claim_path in held:
+            try:
+                os.remove(claim_path)
+            except OSError:
+                pass
+        try:
+            os.remove(self.alive_path)
+        except OSError:
+            pass
+
+
+def run_sharded(input_dir, output_dir, workers=1, claims_dir=None, lease_seconds=120, poll_interval=5.0,
+                **options):
+    # Processes input_dir together with any other nodes pointed at the same
+    # (shared) directory, coordinating through shard_claims. Each node walks
+    # the PDFs in its own random order to keep claim collisions rare, holds
+    # at most `workers` claims at a time and returns once every PDF is done or
+    # failed, waiting out claims held by other nodes so none is lost if that
+    # node dies.
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    os.makedirs(output_dir, exist_ok=True)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    claims = shard_claims(claims_dir or os.path.join(input_dir, ".claims"), lease_seconds=lease_seconds)
+    pdfs = list(_scan_pdfs(input_dir).items())
+    random.Random(claims.node_id).shuffle(pdfs)
+    print(f"Node {claims.node_id}: sharing {len(pdfs)} PDFs with {workers} worker processes")
+
+    finished = set()
+    in_flight = {}      # future -> pdf_path
+    suspects = set()    # pdf_paths in flight when a worker crashed
+    processed = 0
+    failures = []
+
+    claims.start()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            busy = set(in_flight.values())
+            waiting_on_others = False
+            for pdf_path, (_, pdf_mtime) in pdfs:
+                if pdf_path in finished or pdf_path in busy:
+                    continue
+                if claims.is_finished(pdf_path, pdf_mtime):
+                    finished.add(pdf_path)
+                    continue
+                if len(in_flight) >= workers or busy & suspects:
+                    waiting_on_others = True
+                    break
+                if pdf_path in suspects and in_flight:
+                    waiting_on_others = True
+                    continue
+                if claims.try_claim(pdf_path, pdf_mtime):
+                    try:
+                        future = executor.submit(_process_pdf_safely, pdf_path, output_dir, **options)
+                    except BrokenProcessPool:
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                        future = executor.submit(_process_pdf_safely, pdf_path, output_dir, **options)
+                    in_flight[future] = pdf_path
+                    busy.add(pdf_path)
+                else:
+                    waiting_on_others = True
 
-        pdf.close()
+            if not in_flight and not waiting_on_others:
+                break
+
+            if not in_flight:
+                # Only other nodes' claims are left; wait() would return at once.
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                pdf_path = in_flight.pop(future)
+                try:
+                    _, error = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died and took every document in flight down
+                    # with it. Each is released and retried alone on a new
+                    # pool; one that crashes alone failed.
+                    if pdf_path not in suspects:
+                        suspects.add(pdf_path)
+                        claims.release(pdf_path)
+                        continue
+                    error = f"worker crashed: {type(e).__name__}: {e}"
+                except Exception as e:
+                    error = f"worker crashed: {type(e).__name__}: {e}"
+                suspects.discard(pdf_path)
+                claims.finish(pdf_path, error)
+                finished.add(pdf_path)
+                processed += 1
+                if error:
+                    print(f"Failed to process {os.path.basename(pdf_path)}: {error}")
+                    failures.append(pdf_path)
+    finally:
+        executor.shutdown()
+        claims.stop()
+
+    print(f"Node {claims.node_id} processed {processed - len(failures)}/{processed} PDFs successfully")
+    return failures
+
+
+def _warm_worker():
+    # Pool initializer: load the OCR stack once per worker so the first scanned
+    # cover a worker sees doesn't pay for it. Missing tesseract is not fatal.
+    try:
+        with borrowed_ocr_engine():
+            pass
+    except Exception:
+        pass
+
+
+def _extract_pdf_bytes(pdf_bytes, settings=None, ocr_cache=None, page_cache=None):
+    # Returns the same {"output", "method"} record the result cache stores.
+    deadline_s = {**DEFAULT_SETTINGS, **(settings or {})}["deadline_s"]
+    with document_watchdog(deadline_s * WATCHDOG_GRACE):
+        pdf = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            output_data, method = extract_document(pdf, settings=settings, ocr_cache=ocr_cache, page_cache=page_cache)
+        finally:
+            pdf.close()
+    return {"output": output_data, "method": method}
+
+
+class extraction_service:
+    # Keeps a pool of warm worker processes and bounds the work in flight:
+    # at most `workers` documents are parsed at once and at most `max_queue`
+    # more wait for a worker. Anything beyond that is refused straight away
+    # so callers can back off instead of piling up behind a slow document.
+
+    def __init__(self, workers=1, max_queue=16, request_timeout=60, cache=None, settings=None, ocr_cache=None,
+                 page_cache=None):
+        self.workers = max(workers, 1)
+        self.request_timeout = request_timeout
+        self.cache = cache
+        self.ocr_cache = ocr_cache
+        self.page_cache = page_cache
+        self.settings = settings
+        self.slots = threading.BoundedSemaphore(self.workers + max_queue)
+        self.pool_lock = threading.Lock()
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker)
+
+    def extract(self, pdf_bytes):
+        # Returns (http_status, payload).
+        from concurrent.futures import TimeoutError
+        from concurrent.futures.process import BrokenProcessPool
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(pdf_bytes, self.settings)
+            result = self.cache.get(cache_key)
+            if result is not None:
+                return 200, result["output"]
+
+        if not self.slots.acquire(blocking=False):
+            return 503, {"error": "server busy, retry later"}
+        try:
+            with self.pool_lock:
+                pool = self.pool
+            try:
+                future = pool.submit(_extract_pdf_bytes, pdf_bytes, settings=self.settings,
+                                     ocr_cache=self.ocr_cache, page_cache=self.page_cache)
+            except BrokenProcessPool:
+                # The pool broke before any request saw it; start a new one.
+                pool = self._replace_pool(pool)
+                future = pool.submit(_extract_pdf_bytes, pdf_bytes, settings=self.settings,
+                                     ocr_cache=self.ocr_cache, page_cache=self.page_cache)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the worker is done with the document, not
+        # until this request gives up on it: a timed-out document that is
+        # already running keeps its worker busy, and admitting another request
+        # in its place would let the pool's queue grow without bound. A worker
+        # that dies is noticed here too, even after its request has returned.
+        future.add_done_callback(lambda f: self._task_done(f, pool))
+
+        try:
+            result = future.result(timeout=self.request_timeout)
+        except TimeoutError:
+            future.cancel()
+            return 504, {"error": f"extraction took longer than {self.request_timeout}s"}
+        except BrokenProcessPool:
+            return 500, {"error": "worker process crashed"}
+        except Exception as e:
+            return 422, {"error": f"{type(e).__name__}: {e}"}
+
+        if cache_key is not None and "degraded" not in result["output"]:
+            self.cache.put(cache_key, result)
+        return 200, result["output"]
+
+    def _replace_pool(self, broken_pool):
+        # Returns the current pool, first replacing broken_pool if no other
+        # request has done so yet.
+        with self.pool_lock:
+            if self.pool is broken_pool:
+                self.pool = self._new_pool()
+            return self.pool
+
+    def _task_done(self, future, pool):
+        from concurrent.futures.process import BrokenProcessPool
+
+        self.slots.release()
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            # A worker died mid-document; replace the pool for later requests.
+            self._replace_pool(pool)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def serve(service, host="127.0.0.1", port=8000, unix_socket=None, max_request_bytes=200 * 1024 * 1024):
+    # POST /extract with the raw PDF as the body, or with a JSON body
+    # {"path": "..."} naming a file the server can read; the response is the
+    # same {"title", "outline"} JSON the batch mode writes. GET /health is a
+    # liveness probe.
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class request_handler(BaseHTTPRequestHandler):
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else unix_socket
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 503:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/extract":
+                self._send_json(404, {"error": "not found"})
+                return
+
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > max_request_bytes:
+                self._send_json(413 if length else 400, {"error": "missing or oversized request body"})
+                return
+            body = self.rfile.read(length)
+
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                try:
+                    with open(json.loads(body)["path"], 'rb') as pdf_file:
+                        body = pdf_file.read()
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    self._send_json(400, {"error": f"cannot read PDF path: {e}"})
+                    return
+
+            status, payload = service.extract(body)
+            self._send_json(status, payload)
+
+    if unix_socket:
+        class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = unix_http_server(unix_socket, request_handler)
+        print(f"Serving on unix socket {unix_socket}")
+    else:
+        server = ThreadingHTTPServer((host, port), request_handler)
+        print(f"Serving on http://{host}:{server.server_address[1]}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def check_import_budget():
+    # Imports this module in a fresh interpreter with -X importtime and checks
+    # the cumulative import time and the deferred modules against the budget.
+    import subprocess
+
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    probe = f"import sys, {module_name}; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe],
+                            cwd=module_dir, capture_output=True, text=True, check=True)
+
+    import_us = 0
+    for row in result.stderr.splitlines():
+        fields = row.split("|")
+        if len(fields) == 3 and fields[2].strip() == module_name:
+            import_us = int(fields[1])
+    import_ms = import_us / 1000
+    loaded_deferred = [m for m in result.stdout.strip().split(",") if m]
+
+    print(f"Import time of {module_name}: {import_ms:.1f} ms (budget {IMPORT_TIME_BUDGET_MS} ms)")
+    if loaded_deferred:
+        print(f"Deferred modules imported eagerly: {', '.join(loaded_deferred)}")
+    return import_ms <= IMPORT_TIME_BUDGET_MS and not loaded_deferred
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract title and H1-H3 outline from PDFs")
+    parser.add_argument("--input-dir", default="input", help="directory containing the PDFs")
+    parser.add_argument("--output-dir", default="output", help="directory the JSON outlines are written to")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--max-heading-word-percentage", type=float, default=0.10,
+                        help="largest share of the document's words that headings may take up")
+    parser.add_argument("--streaming-min-pages", type=int, default=0,
+                        help="use bounded-memory three-pass extraction for PDFs with at least this many pages "
+                             "(0 = never)")
+    parser.add_argument("--sample-pages", type=int, default=0,
+                        help="with --streaming-min-pages, estimate body style and repeating headers/footers from a "
+                             "stratified sample of this many pages instead of scanning every page twice (0 = no "
+                             "sampling)")
+    parser.add_argument("--ocr-megapixels", type=float, default=0,
+                        help="scanned-document mode: OCR image-only pages, rendering them at a resolution that keeps "
+                             "a document's scanned pages within this many megapixels, e.g. 120 (0 = don't OCR "
+                             "scanned pages)")
+    parser.add_argument("--ocr-max-dpi", type=int, default=300, help="highest resolution scanned pages are OCR'd at")
+    parser.add_argument("--ocr-threads", type=int, default=4, help="scanned pages OCR'd in parallel per document")
+    parser.add_argument("--deadline", type=float, default=0,
+                        help="per-document time budget in seconds; as it runs out underline detection, OCR and "
+                             f"finally further pages are skipped, and after {WATCHDOG_GRACE:g}x the budget the "
+                             "document is aborted (0 = no deadline)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse results for PDFs already processed with the same settings")
+    parser.add_argument("--cache-max-mb", type=float, default=512,
+                        help="size limit of the result cache; least recently used entries are evicted")
+    parser.add_argument("--ocr-cache-dir", default=None,
+                        help="reuse OCR results for images (covers, logos, scanned pages) already seen in any PDF")
+    parser.add_argument("--ocr-cache-max-mb", type=float, default=256,
+                        help="size limit of the OCR cache; least recently used entries are evicted")
+    parser.add_argument("--page-cache-dir", default=None,
+                        help="reuse the features of pages already parsed, so a re-issued PDF only has its changed "
+                             "pages parsed again")
+    parser.add_argument("--page-cache-max-mb", type=float, default=1024,
+                        help="size limit of the page cache; least recently used entries are evicted")
+    parser.add_argument("--metrics-sidecar", action="store_true",
+                        help="write per-stage timings and counters next to each output as <name>.metrics.json")
+    parser.add_argument("--metrics-file", default=None,
+                        help="append one JSON line of timings and counters per document to this file")
+    parser.add_argument("--schedule", choices=("name", "largest-first", "shortest-first"), default="name",
+                        help="order PDFs are processed in: by name, or by a cost estimate from size, page count, "
+                             "TOC and a scanned page 0 - largest first to finish the batch soonest, shortest "
+                             "first to get most outputs out soonest")
+    parser.add_argument("--split-pages", type=int, default=0,
+                        help="with several workers, split PDFs longer than this into page ranges parsed in "
+                             "parallel and merged before scoring (0 = never split)")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="with a single worker, PDFs read ahead in the background while one is parsed "
+                             "(0 = read each PDF when it is needed)")
+    parser.add_argument("--ndjson-dir", default=None,
+                        help="append compact one-line records to rotating NDJSON files in this directory "
+                             "instead of writing one JSON file per PDF")
+    parser.add_argument("--ndjson-max-mb", type=float, default=256,
+                        help="size at which an NDJSON file is closed and a new one started")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process PDFs that are new or changed since their output was written")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="seconds between scans of the input directory in watch and shard mode")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="a PDF must stay unchanged this long before watch mode picks it up")
+    parser.add_argument("--shard", action="store_true",
+                        help="share the input directory with other nodes running --shard against it, each PDF "
+                             "being processed by exactly one of them")
+    parser.add_argument("--claims-dir", default=None,
+                        help="shared directory for the claim and completion markers (default: <input-dir>/.claims)")
+    parser.add_argument("--lease-seconds", type=float, default=120,
+                        help="claims not refreshed for this long are taken to belong to a crashed node and re-queued")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as a local extraction service instead of processing the input directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-queue", type=int, default=16,
+                        help="service: requests allowed to wait for a worker before answering 503; "
+                             "watch mode: documents queued for a worker at any time")
+    parser.add_argument("--request-timeout", type=float, default=60,
+                        help="seconds a request may take before the service answers 504")
+    parser.add_argument("--check-import-budget", action="store_true",
+                        help="measure the text-only import time against IMPORT_TIME_BUDGET_MS and exit")
+    args = parser.parse_args()
+
+    if args.check_import_budget:
+        sys.exit(0 if check_import_budget() else 1)
+
+    settings = {
+        "max_heading_word_percentage": args.max_heading_word_percentage,
+        "streaming_min_pages": args.streaming_min_pages,
+        "sample_pages": args.sample_pages,
+        "ocr_megapixels": args.ocr_megapixels,
+        "ocr_max_dpi": args.ocr_max_dpi,
+        "ocr_threads": args.ocr_threads,
+        "deadline_s": args.deadline,
+    }
+
+    cache = None
+    if args.cache_dir:
+        cache = result_cache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
+    ocr_cache = None
+    if args.ocr_cache_dir:
+        ocr_cache = ocr_result_cache(args.ocr_cache_dir, max_bytes=int(args.ocr_cache_max_mb * 1024 * 1024))
+
+    page_cache = None
+    if args.page_cache_dir:
+        page_cache = page_feature_cache(args.page_cache_dir, max_bytes=int(args.page_cache_max_mb * 1024 * 1024))
+
+    if args.serve:
+        service = extraction_service(workers=args.workers if args.workers > 0 else (os.cpu_count() or 1),
+                                     max_queue=args.max_queue, request_timeout=args.request_timeout,
+                                     cache=cache, settings=settings, ocr_cache=ocr_cache, page_cache=page_cache)
+        serve(service, host=args.host, port=args.port, unix_socket=args.unix_socket)
+        return
+
+    if args.watch and args.ndjson_dir:
+        # Watch mode decides what is up to date from the per-file outputs.
+        parser.error("--ndjson-dir cannot be combined with --watch")
+
+    if args.shard and args.watch:
+        parser.error("--shard cannot be combined with --watch")
+
+    if args.shard:
+        run_sharded(args.input_dir, args.output_dir, workers=args.workers, claims_dir=args.claims_dir,
+                    lease_seconds=args.lease_seconds, poll_interval=args.poll_interval,
+                    cache=cache, settings=settings, ocr_cache=ocr_cache, page_cache=page_cache,
+                    metrics_sidecar=args.metrics_sidecar, metrics_file=args.metrics_file,
+                    ndjson_dir=args.ndjson_dir, ndjson_max_mb=args.ndjson_max_mb)
+        return
+
+    if args.watch:
+        watch_directory(args.input_dir, args.output_dir, workers=args.workers,
+                        poll_interval=args.poll_interval, settle_seconds=args.settle_seconds,
+                        max_queue=args.max_queue, cache=cache, settings=settings, ocr_cache=ocr_cache,
+                        page_cache=page_cache,
+                        metrics_sidecar=args.metrics_sidecar, metrics_file=args.metrics_file)
+        return
+
+    run_batch(args.input_dir, args.output_dir, workers=args.workers, prefetch=args.prefetch,
+              schedule=args.schedule, split_pages=args.split_pages, cache=cache, settings=settings, ocr_cache=ocr_cache, page_cache=page_cache,
+              metrics_sidecar=args.metrics_sidecar, metrics_file=args.metrics_file,
+              ndjson_dir=args.ndjson_dir, ndjson_max_mb=args.ndjson_max_mb)
+
+
+if __name__ == "__main__":
+    main()